@@ -0,0 +1,78 @@
+import heapq
+
+from recommendations import RatersIndex, sim_pearson
+
+
+# Yields (person, rankings) with the top n (score, item) pairs for every person.
+# User-based by default; pass item_match (from calculate_similar_items or an
+# ItemSimilarityIndex) for item-based recommendations instead
+def iter_recommendations(prefs, people=None, n=20, similarity=sim_pearson, item_match=None):
+    if people is None:
+        people = list(prefs)
+
+    # Accumulators are reused for every person instead of being reallocated
+    totals = {}
+    sim_sums = {}
+
+    if item_match is not None:
+        for person in people:
+            totals.clear()
+            sim_sums.clear()
+            user_ratings = prefs[person]
+            for (item, rating) in user_ratings.items():
+                for (sim, item2) in item_match[item]:
+                    if item2 in user_ratings:
+                        continue
+                    totals[item2] = totals.get(item2, 0) + sim * rating
+                    sim_sums[item2] = sim_sums.get(item2, 0) + sim
+
+            rankings = ((score / sim_sums[item], item) for item, score in totals.items()
+                        if sim_sums[item] != 0)
+            yield person, heapq.nlargest(n, rankings)
+        return
+
+    index = RatersIndex(prefs)
+
+    # Similarities are symmetric, so a score computed for (a, b) is kept until b
+    # is processed and then dropped. Only people still to be processed are
+    # cached, so the cache never outgrows the pairs it will be asked for
+    pending = {}
+    people = list(people)
+    remaining = set(people)
+    for person in people:
+        totals.clear()
+        sim_sums.clear()
+        user_ratings = prefs[person]
+        remaining.discard(person)
+
+        for other in index.candidates(person):
+            sim = pending.pop((other, person), None)
+            if sim is None:
+                sim = similarity(prefs, person, other)
+                if other in remaining:
+                    pending[(person, other)] = sim
+
+            # ignore scores of zero or lower
+            if sim <= 0:
+                continue
+            for item, rating in prefs[other].items():
+                # only score items this person hasn't seen yet
+                if item not in user_ratings or user_ratings[item] == 0:
+                    totals[item] = totals.get(item, 0) + rating * sim
+                    sim_sums[item] = sim_sums.get(item, 0) + sim
+
+        rankings = ((total / sim_sums[item], item) for item, total in totals.items())
+        yield person, heapq.nlargest(n, rankings)
+
+
+# Write top n recommendations for every person to filename as tab separated
+# person, item, score lines, streaming each person's list as soon as it is ready
+def recommend_all(prefs, filename, people=None, n=20, similarity=sim_pearson, item_match=None):
+    count = 0
+    with open(filename, 'w', encoding='utf-8') as out:
+        for person, rankings in iter_recommendations(prefs, people=people, n=n,
+                                                     similarity=similarity, item_match=item_match):
+            for score, item in rankings:
+                out.write('%s\t%s\t%f\n' % (person, item, score))
+            count += 1
+    return count
@@ -0,0 +1,146 @@
+import argparse
+import contextlib
+import json
+import os
+import platform
+import random
+import resource
+import sys
+import time
+from math import sqrt
+
+import recommendations
+
+DEFAULT_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'ml-100k')
+
+
+# The u1-u5 base/test splits produced by mku.sh. Reads the files when they have
+# been generated, otherwise splits u.data in memory the same way
+def load_splits(path, titles):
+    data = open(os.path.join(path, 'u.data')).read().splitlines()
+    splits = []
+    for i in range(1, 6):
+        base_file = os.path.join(path, 'u%d.base' % i)
+        test_file = os.path.join(path, 'u%d.test' % i)
+        if os.path.exists(base_file) and os.path.exists(test_file):
+            base = open(base_file).read().splitlines()
+            test = open(test_file).read().splitlines()
+        else:
+            test = data[(i - 1) * 20000:i * 20000]
+            base = data[:(i - 1) * 20000] + data[i * 20000:]
+        splits.append(('u%d' % i, recommendations.parse_ratings(base, titles),
+                       recommendations.parse_ratings(test, titles)))
+    return splits
+
+
+def percentiles(samples):
+    samples = sorted(samples)
+
+    def pick(q):
+        return samples[min(len(samples) - 1, int(q * len(samples)))]
+    return {'count': len(samples), 'mean_ms': 1000 * sum(samples) / len(samples),
+            'p50_ms': 1000 * pick(0.50), 'p99_ms': 1000 * pick(0.99)}
+
+
+def time_calls(fn, args_list):
+    samples = []
+    for args in args_list:
+        start = time.perf_counter()
+        fn(*args)
+        samples.append(time.perf_counter() - start)
+    return percentiles(samples)
+
+
+def peak_rss_kb():
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is bytes on macOS and kilobytes on Linux
+    if sys.platform == 'darwin':
+        rss //= 1024
+    return rss
+
+
+# Latency of the main recommendation calls on the full data set
+def latency(path, people, build_items):
+    results = {}
+
+    start = time.perf_counter()
+    prefs = recommendations.load_movielens(path)
+    results['load_movielens_s'] = time.perf_counter() - start
+
+    results['top_matches'] = time_calls(recommendations.top_matches, [(prefs, p) for p in people])
+    results['get_recommendations'] = time_calls(recommendations.get_recommendations,
+                                                [(prefs, p) for p in people])
+
+    if build_items:
+        start = time.perf_counter()
+        # Keep the progress output out of the JSON report
+        with contextlib.redirect_stdout(sys.stderr):
+            item_match = recommendations.calculate_similar_items(prefs)
+        results['calculate_similar_items_s'] = time.perf_counter() - start
+        results['get_recommended_items'] = time_calls(recommendations.get_recommended_items,
+                                                      [(prefs, item_match, p) for p in people])
+
+    results['peak_rss_kb'] = peak_rss_kb()
+    return results
+
+
+# RMSE/MAE of user-based get_recommendations predictions on the held-out ratings.
+# Test ratings the recommender has no prediction for only count against coverage
+def accuracy(path, sample=None, seed=0):
+    titles = recommendations.load_titles(path)
+    results = {}
+    for name, base, test in load_splits(path, titles):
+        people = [p for p in test if p in base]
+        if sample is not None:
+            people = random.Random(seed).sample(people, min(sample, len(people)))
+
+        squared = absolute = 0.0
+        predicted = total = 0
+        for person in people:
+            predictions = dict((item, score) for score, item in
+                               recommendations.get_recommendations(base, person))
+            for item, rating in test[person].items():
+                total += 1
+                if item in predictions:
+                    error = predictions[item] - rating
+                    squared += error * error
+                    absolute += abs(error)
+                    predicted += 1
+
+        results[name] = {'rmse': sqrt(squared / max(predicted, 1)),
+                         'mae': absolute / max(predicted, 1),
+                         'coverage': float(predicted) / max(total, 1),
+                         'people': len(people)}
+    return results
+
+
+def run(path=DEFAULT_PATH, sample=50, accuracy_sample=None, build_items=True, seed=0):
+    prefs = recommendations.load_movielens(path)
+    rng = random.Random(seed)
+    people = rng.sample(sorted(prefs), min(sample, len(prefs)))
+
+    return {'dataset': os.path.abspath(path),
+            'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'sample': sample,
+            'latency': latency(path, people, build_items),
+            'accuracy': accuracy(path, accuracy_sample, seed)}
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark the recommenders on MovieLens data')
+    parser.add_argument('--path', default=DEFAULT_PATH, help='MovieLens data directory')
+    parser.add_argument('--sample', type=int, default=50, help='people to time per call')
+    parser.add_argument('--accuracy-sample', type=int, default=None,
+                        help='people per split for RMSE/MAE (default: all)')
+    parser.add_argument('--skip-items', action='store_true', help='skip calculate_similar_items')
+    parser.add_argument('--output', help='write JSON results here instead of stdout')
+    args = parser.parse_args()
+
+    report = run(args.path, args.sample, args.accuracy_sample, not args.skip_items)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2, sort_keys=True)
+    else:
+        print(json.dumps(report, indent=2, sort_keys=True))
@@ -0,0 +1,94 @@
+import numpy as np
+
+from prefmatrix import PrefMatrix
+
+
+# Latent-factor recommender trained with alternating least squares. Every person
+# and item gets a vector of `factors` numbers, and a predicted rating is the
+# global mean plus the dot product of the two vectors
+class MatrixFactorization:
+    def __init__(self, factors=10, regularization=1.0, iterations=15, seed=None):
+        self.factors = factors
+        self.regularization = regularization
+        self.iterations = iterations
+        self.seed = seed
+
+    def train(self, prefs):
+        matrix = PrefMatrix(prefs)
+        self.people = matrix.people
+        self.items = matrix.items
+        self.person_index = matrix.person_index
+        self.item_index = matrix.item_index
+
+        rated = matrix.rated
+        self.mean = matrix.ratings.sum() / max(rated.sum(), 1)
+        residuals = (matrix.ratings - self.mean) * rated
+
+        rng = np.random.RandomState(self.seed)
+        self.person_factors = rng.normal(scale=0.1, size=(len(self.people), self.factors))
+        self.item_factors = rng.normal(scale=0.1, size=(len(self.items), self.factors))
+
+        # Each half step solves every person's (or item's) regularised least
+        # squares problem at once as a stack of small factors x factors systems
+        for i in range(self.iterations):
+            self.person_factors = self._solve(rated, residuals, self.item_factors)
+            self.item_factors = self._solve(rated.T, residuals.T, self.person_factors)
+
+        self.rated = rated.astype(bool)
+        return self
+
+    def _solve(self, rated, residuals, fixed):
+        eye = self.regularization * np.eye(self.factors)
+        outer = (fixed[:, :, np.newaxis] * fixed[:, np.newaxis, :]).reshape(len(fixed), -1)
+        a = rated.dot(outer).reshape(len(rated), self.factors, self.factors) + eye
+        b = residuals.dot(fixed)
+        return np.linalg.solve(a, b[:, :, np.newaxis])[:, :, 0]
+
+    def predict(self, person, item):
+        return float(self.mean + self.person_factors[self.person_index[person]].dot(
+            self.item_factors[self.item_index[item]]))
+
+    # Same (score, item) output as get_recommendations, scoring every item the
+    # person hasn't rated with one product against the item factor matrix
+    def get_recommendations(self, person, n=None):
+        i = self.person_index[person]
+        scores = self.mean + self.item_factors.dot(self.person_factors[i])
+
+        rankings = [(float(scores[j]), self.items[j]) for j in np.nonzero(~self.rated[i])[0]]
+        rankings.sort()
+        rankings.reverse()
+        if n is not None:
+            return rankings[0:n]
+        return rankings
+
+    def save(self, filename):
+        np.savez(npz_name(filename),
+                 params=np.array([self.factors, self.regularization, self.iterations, self.mean]),
+                 people=np.array(self.people, dtype=object),
+                 items=np.array(self.items, dtype=object),
+                 person_factors=self.person_factors,
+                 item_factors=self.item_factors,
+                 rated=np.packbits(self.rated, axis=1))
+
+    @staticmethod
+    def load(filename):
+        data = np.load(npz_name(filename), allow_pickle=True)
+        factors, regularization, iterations, mean = data['params'].tolist()
+        model = MatrixFactorization(int(factors), regularization, int(iterations))
+        model.mean = mean
+        model.people = data['people'].tolist()
+        model.items = data['items'].tolist()
+        model.person_index = dict((p, i) for i, p in enumerate(model.people))
+        model.item_index = dict((it, j) for j, it in enumerate(model.items))
+        model.person_factors = data['person_factors']
+        model.item_factors = data['item_factors']
+        model.rated = np.unpackbits(data['rated'], axis=1)[:, :len(model.items)].astype(bool)
+        return model
+
+
+# np.savez appends .npz to names without it, so MatrixFactorization.save and
+# load both add it
+def npz_name(filename):
+    if filename.endswith('.npz'):
+        return filename
+    return filename + '.npz'
@@ -0,0 +1,76 @@
+import pickle
+
+from recommendations import sim_distance, top_matches, transform_prefs
+
+
+# Item-to-item neighbour lists, in the same {item: [(score, item2), ...]} shape
+# calculate_similar_items returns, that can be saved to disk and patched when
+# new ratings arrive instead of being rebuilt from scratch
+class ItemSimilarityIndex:
+    def __init__(self, prefs, n=10, similarity=sim_distance):
+        self.n = n
+        self.similarity = similarity
+        self.item_prefs = transform_prefs(prefs)
+        self.item_match = {}
+        for item in self.item_prefs:
+            self.item_match[item] = top_matches(self.item_prefs, item, n=n, similarity=similarity)
+
+    # Lets the index be passed straight to get_recommended_items as item_match
+    def __getitem__(self, item):
+        return self.item_match[item]
+
+    def __contains__(self, item):
+        return item in self.item_match
+
+    def __len__(self):
+        return len(self.item_match)
+
+    def save(self, filename):
+        with open(filename, 'wb') as f:
+            pickle.dump(self, f, pickle.HIGHEST_PROTOCOL)
+
+    @staticmethod
+    def load(filename):
+        with open(filename, 'rb') as f:
+            return pickle.load(f)
+
+    # Apply a batch of new or changed ratings ({person: {item: rating}}) to prefs
+    # and refresh only the neighbour lists those ratings can affect
+    def update(self, prefs, new_ratings):
+        changed = set()
+        for person, ratings in new_ratings.items():
+            prefs.setdefault(person, {})
+            for item, rating in ratings.items():
+                prefs[person][item] = rating
+                self.item_prefs.setdefault(item, {})[person] = rating
+                changed.add(item)
+
+        # Items whose own ratings changed need a full rescan
+        for item in changed:
+            self.item_match[item] = top_matches(self.item_prefs, item, n=self.n,
+                                                similarity=self.similarity)
+
+        # Every other item only changed its similarity to the changed items
+        for item in self.item_prefs:
+            if item in changed:
+                continue
+
+            old_scores = dict((other, score) for score, other in self.item_match[item])
+            new_scores = dict((other, self.similarity(self.item_prefs, item, other))
+                              for other in changed)
+
+            # If a current neighbour got less similar, something outside the list
+            # may now beat it, so this item needs a full rescan
+            if any(new_scores[other] < old_scores[other] for other in new_scores if other in old_scores):
+                self.item_match[item] = top_matches(self.item_prefs, item, n=self.n,
+                                                    similarity=self.similarity)
+                continue
+
+            scores = [(score, other) for score, other in self.item_match[item]
+                      if other not in new_scores]
+            scores.extend((score, other) for other, score in new_scores.items())
+            scores.sort()
+            scores.reverse()
+            self.item_match[item] = scores[0:self.n]
+
+        return changed
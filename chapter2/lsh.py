@@ -0,0 +1,91 @@
+import numpy as np
+
+from recommendations import sim_pearson, top_matches
+
+
+# Random-projection locality sensitive hashing over mean-centred rating vectors.
+# People whose centred ratings point the same way (high Pearson correlation)
+# tend to land in the same bucket, so candidates(person) returns a small set of
+# likely neighbours without scanning everyone.
+#
+# bits is the number of hyperplanes per table: more bits means smaller buckets,
+# faster queries and lower recall. tables is the number of independent hash
+# tables whose buckets are unioned: more tables means higher recall and more
+# candidates to score.
+#
+# The defaults favour speed over recall. On ml-100k (measure_recall, n=5, 20
+# people) bits=8, tables=4 scans 1.7% of people but finds only 6% of the exact
+# top matches; bits=6, tables=8 finds 41% scanning 13%, bits=5, tables=16 finds
+# 77% scanning 43% and bits=4, tables=16 finds 89% scanning 69%. Exact Pearson
+# neighbours there are dominated by people with tiny overlaps, which no
+# projection predicts well; measure_recall on your own data to pick the knobs.
+class LSHIndex:
+    def __init__(self, prefs, bits=8, tables=4, seed=None):
+        self.bits = bits
+        self.tables = tables
+
+        self.people = list(prefs)
+        self.person_index = dict((p, i) for i, p in enumerate(self.people))
+        items = sorted(set(item for person in prefs for item in prefs[person]))
+        item_index = dict((it, j) for j, it in enumerate(items))
+
+        # One random hyperplane coordinate per item, bit and table
+        rng = np.random.RandomState(seed)
+        planes = np.hstack([rng.standard_normal((len(items), bits)) for t in range(tables)])
+
+        # Each person's projection is the sum of the plane rows of the items
+        # they rated, weighted by their ratings centred on their own mean, so
+        # no dense people x items matrix is ever built
+        projections = np.empty((len(self.people), tables * bits))
+        for i, person in enumerate(self.people):
+            ratings = prefs[person]
+            columns = np.array([item_index[item] for item in ratings], dtype=np.int64)
+            centred = np.array(list(ratings.values()), dtype=np.float64)
+            if len(centred):
+                centred -= centred.mean()
+            projections[i] = centred.dot(planes[columns])
+
+        weights = 1 << np.arange(bits)
+        self.signatures = []
+        self.buckets = []
+        for t in range(tables):
+            signatures = (projections[:, t * bits:(t + 1) * bits] > 0).dot(weights)
+
+            buckets = {}
+            for i, signature in enumerate(signatures.tolist()):
+                buckets.setdefault(signature, []).append(self.people[i])
+            self.signatures.append(signatures)
+            self.buckets.append(buckets)
+
+    # Everyone sharing at least one bucket with person
+    def candidates(self, person):
+        i = self.person_index[person]
+        result = set()
+        for signatures, buckets in zip(self.signatures, self.buckets):
+            result.update(buckets[int(signatures[i])])
+        result.discard(person)
+        return result
+
+
+# Compare approximate top_matches against the exact scan. Returns the average
+# fraction of the exact top n found through the index and the average fraction
+# of people the index asked to be scored. Anyone tied with the exact n-th score
+# counts as a hit, since the exact ranking breaks those ties by name
+def measure_recall(prefs, index, people=None, n=5, similarity=sim_pearson):
+    if people is None:
+        people = list(prefs)
+
+    recall = 0.0
+    scanned = 0.0
+    for person in people:
+        exact = top_matches(prefs, person, n=n, similarity=similarity)
+        approx = top_matches(prefs, person, n=n, similarity=similarity, index=index)
+        if exact:
+            threshold = exact[-1][0] - 1e-9
+            hits = len([score for score, other in approx if score >= threshold])
+            recall += float(hits) / len(exact)
+        else:
+            recall += 1.0
+        scanned += float(len(index.candidates(person))) / max(len(prefs) - 1, 1)
+
+    return recall / len(people), scanned / len(people)
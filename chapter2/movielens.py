@@ -0,0 +1,96 @@
+import json
+import os
+import tempfile
+
+import numpy as np
+
+from recommendations import load_titles
+
+DEFAULT_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'ml-100k')
+
+
+# Columnar view of a MovieLens ratings file: one int32 user id, int32 item id
+# and float32 rating per rating, memory-mapped from a binary cache
+class Ratings:
+    def __init__(self, users, items, ratings, titles):
+        self.users = users
+        self.items = items
+        self.ratings = ratings
+        self.titles = titles
+
+    def __len__(self):
+        return len(self.ratings)
+
+    # Build the {user: {title: rating}} dictionary the recommendations module uses
+    def to_prefs(self):
+        prefs = {}
+        for user, item, rating in zip(self.users.tolist(), self.items.tolist(), self.ratings.tolist()):
+            prefs.setdefault(str(user), {})
+            prefs[str(user)][self.titles[str(item)]] = rating
+        return prefs
+
+
+def _cache_files(cache_dir):
+    return dict((name, os.path.join(cache_dir, name + '.npy')) for name in ('users', 'items', 'ratings'))
+
+
+def _is_fresh(cache_dir, sources):
+    files = list(_cache_files(cache_dir).values()) + [os.path.join(cache_dir, 'titles.json')]
+    if not all(os.path.exists(f) for f in files):
+        return False
+    built = min(os.path.getmtime(f) for f in files)
+    return all(os.path.getmtime(s) <= built for s in sources)
+
+
+def build_cache(path=DEFAULT_PATH, cache_dir=None):
+    if cache_dir is None:
+        cache_dir = os.path.join(path, 'cache')
+    os.makedirs(cache_dir, exist_ok=True)
+
+    # Get movie titles
+    titles = load_titles(path)
+
+    # Parse the ratings straight into columns
+    data = np.loadtxt(os.path.join(path, 'u.data'), dtype=np.int64, usecols=(0, 1, 2), ndmin=2)
+
+    # Every file is written under a temporary name and renamed into place, so a
+    # process loading the cache concurrently never maps a half-written file.
+    # titles.json goes last: the cache only counts as built once it exists
+    files = _cache_files(cache_dir)
+    _replace(files['users'], lambda f: np.save(f, data[:, 0].astype(np.int32)))
+    _replace(files['items'], lambda f: np.save(f, data[:, 1].astype(np.int32)))
+    _replace(files['ratings'], lambda f: np.save(f, data[:, 2].astype(np.float32)))
+    _replace(os.path.join(cache_dir, 'titles.json'), lambda f: f.write(json.dumps(titles).encode('utf-8')))
+
+    return cache_dir
+
+
+def _replace(filename, write):
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(filename), prefix='.' + os.path.basename(filename))
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            write(f)
+        os.replace(tmp, filename)
+    except BaseException:
+        os.remove(tmp)
+        raise
+
+
+# Load ratings from path, building the binary cache the first time (or whenever
+# u.data/u.item are newer than it) and memory-mapping it afterwards
+def load_ratings(path=DEFAULT_PATH, cache_dir=None):
+    if cache_dir is None:
+        cache_dir = os.path.join(path, 'cache')
+
+    sources = [os.path.join(path, 'u.data'), os.path.join(path, 'u.item')]
+    if not _is_fresh(cache_dir, sources):
+        build_cache(path, cache_dir)
+
+    files = _cache_files(cache_dir)
+    with open(os.path.join(cache_dir, 'titles.json')) as f:
+        titles = json.load(f)
+
+    return Ratings(np.load(files['users'], mmap_mode='r'),
+                   np.load(files['items'], mmap_mode='r'),
+                   np.load(files['ratings'], mmap_mode='r'),
+                   titles)
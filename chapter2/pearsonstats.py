@@ -0,0 +1,100 @@
+from collections import OrderedDict
+from math import sqrt
+
+from recommendations import sim_pearson
+
+
+# Keeps the sums sim_pearson needs (n, sum1, sum2, sum1Sq, sum2Sq, pSum) for
+# pairs of people and updates them as single ratings stream in, so a Pearson
+# score is read in O(1) instead of being recomputed from raw ratings.
+#
+# A pair is only tracked once its score has been asked for and the two share
+# at least min_overlap items, and at most max_pairs pairs are kept (the least
+# recently used one is dropped first). Untracked pairs are scored from the raw
+# ratings and start being tracked from then on.
+class PearsonStats:
+    def __init__(self, prefs=None, min_overlap=2, max_pairs=100000):
+        self.min_overlap = min_overlap
+        self.max_pairs = max_pairs
+        self.prefs = {}
+        self.raters = {}
+        self.stats = OrderedDict()
+
+        if prefs is not None:
+            for person in prefs:
+                for item, rating in prefs[person].items():
+                    self.add_rating(person, item, rating)
+
+    @staticmethod
+    def _key(p1, p2):
+        if p1 < p2:
+            return (p1, p2), False
+        return (p2, p1), True
+
+    def _full_stats(self, p1, p2):
+        si = [item for item in self.prefs[p1] if item in self.prefs[p2]]
+        a = [self.prefs[p1][it] for it in si]
+        b = [self.prefs[p2][it] for it in si]
+        return [len(si), sum(a), sum(b),
+                sum([pow(x, 2) for x in a]), sum([pow(y, 2) for y in b]),
+                sum([x * y for x, y in zip(a, b)])]
+
+    # Add a new rating or change an existing one
+    def add_rating(self, person, item, rating):
+        user_ratings = self.prefs.setdefault(person, {})
+        old = user_ratings.get(item)
+        user_ratings[item] = rating
+        raters = self.raters.setdefault(item, {})
+        raters[person] = rating
+
+        for other, other_rating in raters.items():
+            if other == person:
+                continue
+            key, swapped = self._key(person, other)
+            s = self.stats.get(key)
+            if s is None:
+                continue
+
+            if old is None:
+                s[0] += 1
+                s[1] += rating if not swapped else other_rating
+                s[2] += other_rating if not swapped else rating
+                s[3] += pow(rating if not swapped else other_rating, 2)
+                s[4] += pow(other_rating if not swapped else rating, 2)
+                s[5] += rating * other_rating
+            else:
+                diff = rating - old
+                diff_sq = pow(rating, 2) - pow(old, 2)
+                if not swapped:
+                    s[1] += diff
+                    s[3] += diff_sq
+                else:
+                    s[2] += diff
+                    s[4] += diff_sq
+                s[5] += diff * other_rating
+
+    # Drop-in replacement for recommendations.sim_pearson, e.g.
+    # top_matches(stats.prefs, person, similarity=stats.sim_pearson). prefs is
+    # only there to match that signature: scores always come from the ratings
+    # added to these stats
+    def sim_pearson(self, prefs, p1, p2):
+        key, swapped = self._key(p1, p2)
+        s = self.stats.get(key)
+        if s is None:
+            s = self._full_stats(key[0], key[1])
+            if s[0] < self.min_overlap:
+                return sim_pearson(self.prefs, p1, p2)
+            self.stats[key] = s
+            if len(self.stats) > self.max_pairs:
+                self.stats.popitem(last=False)
+        else:
+            self.stats.move_to_end(key)
+
+        n, sum1, sum2, sum1Sq, sum2Sq, pSum = s
+        if n == 0:
+            return 0
+        num = pSum - (sum1 * sum2 / n)
+        den = sqrt(max((sum1Sq - pow(sum1, 2) / n) * (sum2Sq - pow(sum2, 2) / n), 0))
+        if den == 0:
+            return 0
+        return num / den
@@ -0,0 +1,103 @@
+import numpy as np
+
+from recommendations import sim_pearson, sim_distance
+
+
+# Dense matrix view of a prefs dictionary. Every person is a row and every
+# item is a column, so one person can be scored against everyone in a single
+# batch of matrix-vector products instead of one sim_* call per person
+class PrefMatrix:
+    def __init__(self, prefs):
+        self.people = list(prefs)
+        self.items = sorted(set(item for person in prefs for item in prefs[person]))
+        self.person_index = dict((p, i) for i, p in enumerate(self.people))
+        self.item_index = dict((it, j) for j, it in enumerate(self.items))
+
+        # ratings holds the scores, rated marks which cells actually have one
+        # (a rating of 0 is still a rating)
+        self.ratings = np.zeros((len(self.people), len(self.items)))
+        self.rated = np.zeros((len(self.people), len(self.items)))
+        for person, i in self.person_index.items():
+            for item, rating in prefs[person].items():
+                j = self.item_index[item]
+                self.ratings[i, j] = rating
+                self.rated[i, j] = 1.0
+
+        self.ratings_sq = self.ratings ** 2
+
+    # Euclidean distance score of person against every row, same formula as sim_distance
+    def sim_distance_all(self, person):
+        i = self.person_index[person]
+        r = self.ratings[i]
+        m = self.rated[i]
+
+        # sum over shared items of (a - b)^2 = sum(a^2) + sum(b^2) - 2 * sum(a * b)
+        shared = self.rated.dot(m)
+        sum_of_squares = (self.rated.dot(r ** 2) + self.ratings_sq.dot(m)
+                          - 2 * self.ratings.dot(r))
+        sum_of_squares = np.maximum(sum_of_squares, 0.0)
+
+        scores = 1 / (1 + np.sqrt(sum_of_squares))
+        scores[shared == 0] = 0
+        return scores
+
+    # Pearson correlation of person against every row, same formula as sim_pearson
+    def sim_pearson_all(self, person):
+        i = self.person_index[person]
+        r = self.ratings[i]
+        m = self.rated[i]
+
+        # Every sum is restricted to the items both people rated
+        n = self.rated.dot(m)
+        sum1 = self.rated.dot(r)
+        sum2 = self.ratings.dot(m)
+        sum1_sq = self.rated.dot(r ** 2)
+        sum2_sq = self.ratings_sq.dot(m)
+        p_sum = self.ratings.dot(r)
+
+        with np.errstate(divide='ignore', invalid='ignore'):
+            num = p_sum - (sum1 * sum2 / n)
+            den = np.sqrt((sum1_sq - sum1 ** 2 / n) * (sum2_sq - sum2 ** 2 / n))
+            scores = num / den
+
+        # No shared items or no variance both score 0, just like sim_pearson
+        scores[(n == 0) | ~(den > 0)] = 0
+        return scores
+
+    def similarities(self, person, similarity=sim_pearson):
+        if similarity is sim_pearson or similarity == 'pearson':
+            return self.sim_pearson_all(person)
+        if similarity is sim_distance or similarity == 'distance':
+            return self.sim_distance_all(person)
+        raise ValueError('Unsupported similarity %r' % (similarity,))
+
+    # Same result as recommendations.top_matches
+    def top_matches(self, person, n=5, similarity=sim_pearson):
+        sims = self.similarities(person, similarity)
+        scores = [(float(sims[i]), other) for i, other in enumerate(self.people)
+                  if other != person]
+
+        scores.sort()
+        scores.reverse()
+        return scores[0:n]
+
+    # Same result as recommendations.get_recommendations
+    def get_recommendations(self, person, similarity=sim_pearson):
+        i = self.person_index[person]
+        sims = self.similarities(person, similarity)
+
+        # Ignore myself and every score of zero or lower
+        sims[i] = 0
+        sims[sims <= 0] = 0
+
+        totals = sims.dot(self.ratings)
+        sim_sums = sims.dot(self.rated)
+
+        # Only score items I haven't seen yet (or rated 0) that someone similar rated
+        unseen = (self.rated[i] == 0) | (self.ratings[i] == 0)
+        candidates = np.nonzero(unseen & (sim_sums > 0))[0]
+
+        rankings = [(float(totals[j] / sim_sums[j]), self.items[j]) for j in candidates]
+        rankings.sort()
+        rankings.reverse()
+        return rankings
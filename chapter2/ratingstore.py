@@ -0,0 +1,206 @@
+import os
+from array import array
+from bisect import bisect_left
+from collections.abc import Mapping
+from math import sqrt
+
+import numpy as np
+
+from recommendations import iter_ratings, load_titles
+
+DEFAULT_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'ml-100k')
+
+
+# One person's ratings: a view of their slice of the store's arrays. Looks like
+# the {item: rating} dict the recommendations functions expect
+class Row(Mapping):
+    __slots__ = ('store', 'user_id')
+
+    def __init__(self, store, user_id):
+        self.store = store
+        self.user_id = user_id
+
+    def _find(self, item):
+        store = self.store
+        item_id = store.item_ids.get(item)
+        if item_id is None:
+            return None
+        lo = store.indptr[self.user_id]
+        hi = store.indptr[self.user_id + 1]
+        i = bisect_left(store.row_items, item_id, lo, hi)
+        if i < hi and store.row_items[i] == item_id:
+            return i
+        return None
+
+    def __getitem__(self, item):
+        i = self._find(item)
+        if i is None:
+            raise KeyError(item)
+        return self.store.row_ratings[i]
+
+    def __contains__(self, item):
+        return self._find(item) is not None
+
+    def __iter__(self):
+        store = self.store
+        names = store.item_names
+        return (names[item_id] for item_id in
+                store.row_items[store.indptr[self.user_id]:store.indptr[self.user_id + 1]])
+
+    def __len__(self):
+        return self.store.indptr[self.user_id + 1] - self.store.indptr[self.user_id]
+
+    def items(self):
+        store = self.store
+        names = store.item_names
+        lo = store.indptr[self.user_id]
+        hi = store.indptr[self.user_id + 1]
+        return [(names[item_id], rating) for item_id, rating in
+                zip(store.row_items[lo:hi], store.row_ratings[lo:hi])]
+
+
+# Compact ratings store with interned integer ids for people and items. Acts as
+# a read-only {person: {item: rating}} mapping, so it can be passed as prefs to
+# sim_distance, sim_pearson, transform_prefs, top_matches and get_recommendations.
+#
+# All ratings live in two flat arrays sorted by person then item, with indptr
+# marking where each person's slice starts (compressed sparse rows). New
+# ratings are buffered and merged into the arrays on the next read, so adding
+# many ratings before reading costs one merge
+class RatingStore(Mapping):
+    def __init__(self, prefs=None):
+        self.user_ids = {}
+        self.user_names = []
+        self.item_ids = {}
+        self.item_names = []
+        self.indptr = array('l', [0])
+        self.row_items = array('H')
+        self.row_ratings = array('f')
+        self.pending = {}
+        self.rows = []
+
+        if prefs is not None:
+            for person in prefs:
+                for item, rating in prefs[person].items():
+                    self.add(person, item, rating)
+
+    def intern_user(self, person):
+        user_id = self.user_ids.get(person)
+        if user_id is None:
+            user_id = len(self.user_names)
+            self.user_ids[person] = user_id
+            self.user_names.append(person)
+        return user_id
+
+    def intern_item(self, item):
+        item_id = self.item_ids.get(item)
+        if item_id is None:
+            item_id = len(self.item_names)
+            self.item_ids[item] = item_id
+            self.item_names.append(item)
+        return item_id
+
+    # Add or change a rating
+    def add(self, person, item, rating):
+        user_id = self.intern_user(person)
+        item_id = self.intern_item(item)
+
+        # Ratings already in the arrays are changed in place
+        if user_id + 1 < len(self.indptr):
+            lo = self.indptr[user_id]
+            hi = self.indptr[user_id + 1]
+            i = bisect_left(self.row_items, item_id, lo, hi)
+            if i < hi and self.row_items[i] == item_id:
+                self.row_ratings[i] = rating
+                return
+        self.pending.setdefault(user_id, {})[item_id] = rating
+
+    # Merge the buffered ratings into the arrays
+    def flush(self):
+        if not self.pending and len(self.rows) == len(self.user_names):
+            return
+
+        # Item ids are stored in two bytes until there are too many items
+        typecode = 'H' if len(self.item_names) <= 65536 else 'l'
+        row_items = array(typecode)
+        row_ratings = array('f')
+        indptr = array('l', [0])
+        for user_id in range(len(self.user_names)):
+            if user_id + 1 < len(self.indptr):
+                lo = self.indptr[user_id]
+                hi = self.indptr[user_id + 1]
+            else:
+                lo = hi = 0
+            extra = self.pending.get(user_id)
+            if extra:
+                merged = sorted(list(zip(self.row_items[lo:hi], self.row_ratings[lo:hi])) +
+                                list(extra.items()))
+                row_items.extend([item_id for item_id, rating in merged])
+                row_ratings.extend([rating for item_id, rating in merged])
+            else:
+                row_items.extend(self.row_items[lo:hi] if typecode == self.row_items.typecode
+                                 else array(typecode, self.row_items[lo:hi]))
+                row_ratings.extend(self.row_ratings[lo:hi])
+            indptr.append(len(row_items))
+
+        self.row_items = row_items
+        self.row_ratings = row_ratings
+        self.indptr = indptr
+        self.pending = {}
+        self.rows.extend(Row(self, user_id) for user_id in range(len(self.rows), len(self.user_names)))
+
+    def __getitem__(self, person):
+        if self.pending or len(self.rows) != len(self.user_names):
+            self.flush()
+        return self.rows[self.user_ids[person]]
+
+    def __contains__(self, person):
+        return person in self.user_ids
+
+    def __iter__(self):
+        return iter(self.user_names)
+
+    def __len__(self):
+        return len(self.user_names)
+
+    # Drop-in replacement for recommendations.sim_pearson, e.g.
+    # top_matches(store, person, similarity=store.sim_pearson). Finds the shared
+    # items by intersecting the two people's sorted item ids instead of looking
+    # every item up one at a time. prefs is only there to match that signature
+    def sim_pearson(self, prefs, p1, p2):
+        self.flush()
+        items = np.frombuffer(self.row_items, dtype=self.row_items.typecode)
+        ratings = np.frombuffer(self.row_ratings, dtype=np.float32)
+        u1 = self.user_ids[p1]
+        u2 = self.user_ids[p2]
+        lo1, hi1 = self.indptr[u1], self.indptr[u1 + 1]
+        lo2, hi2 = self.indptr[u2], self.indptr[u2 + 1]
+        common, i1, i2 = np.intersect1d(items[lo1:hi1], items[lo2:hi2], assume_unique=True,
+                                        return_indices=True)
+
+        # if they are no ratings in common, return 0
+        n = len(common)
+        if n == 0:
+            return 0
+
+        a = ratings[lo1:hi1][i1].astype(np.float64)
+        b = ratings[lo2:hi2][i2].astype(np.float64)
+        sum1 = a.sum()
+        sum2 = b.sum()
+        num = a.dot(b) - (sum1 * sum2 / n)
+        den = sqrt((a.dot(a) - pow(sum1, 2) / n) * (b.dot(b) - pow(sum2, 2) / n))
+        if den == 0:
+            return 0
+        return float(num / den)
+
+
+# Load MovieLens ratings into a RatingStore. Titles that appear more than once in
+# u.item get their movie id appended so they no longer overwrite each other
+def load_movielens(path=DEFAULT_PATH):
+    movies = load_titles(path, disambiguate=True)
+
+    store = RatingStore()
+    with open(os.path.join(path, 'u.data')) as f:
+        for (user, title, rating) in iter_ratings(f, movies):
+            store.add(user, title, rating)
+    return store
@@ -1,4 +1,6 @@
+import os
 from math import sqrt
+from multiprocessing import Pool
 
 # A dictionary of movie critics and their ratings of a small
 # set of movies
@@ -90,9 +92,12 @@ def sim_pearson(prefs, p1, p2):
 
 # Returns the best matches for person from the prefs dictionary
 # Number of results and similarity function are optional params
-def top_matches(prefs, person, n=5, similarity=sim_pearson):
+# An optional index (anything with a candidates(person) method) limits the
+# scan to the people it returns instead of everyone in prefs
+def top_matches(prefs, person, n=5, similarity=sim_pearson, index=None):
+    others = prefs if index is None else index.candidates(person)
     scores = [(similarity(prefs, person, other), other)
-              for other in prefs if other != person]
+              for other in others if other != person]
 
     # Sort the list so the highest scores appears on the top
     scores.sort()
@@ -102,10 +107,11 @@ def top_matches(prefs, person, n=5, similarity=sim_pearson):
 
 # Gets recommendations for a person using a weighted average
 # of every other user's rankings
-def get_recommendations(prefs, person, similarity=sim_pearson):
+def get_recommendations(prefs, person, similarity=sim_pearson, index=None):
     totals = {}
     sim_sums = {}
-    for other in prefs:
+    others = prefs if index is None else index.candidates(person)
+    for other in others:
         # don't compare to myself
         if other == person:
             continue
@@ -143,18 +149,75 @@ def transform_prefs(prefs):
     return result
 
 
-def calculate_similar_items(prefs, n=10):
+# Inverted item -> {person: rating} index kept next to prefs. People with no
+# co-rated items always score 0, so passing this as the index to top_matches or
+# get_recommendations only visits people who share at least one item
+class RatersIndex:
+    def __init__(self, prefs):
+        self.prefs = prefs
+        self.raters = transform_prefs(prefs)
+
+    # Add or change a rating in both prefs and the index
+    def add_rating(self, person, item, rating):
+        self.prefs.setdefault(person, {})[item] = rating
+        self.raters.setdefault(item, {})[person] = rating
+
+    # Number of items person shares with everyone they overlap with
+    def overlap(self, person):
+        counts = {}
+        for item in self.prefs[person]:
+            for other in self.raters[item]:
+                if other == person:
+                    continue
+                counts.setdefault(other, 0)
+                counts[other] += 1
+        return counts
+
+    def candidates(self, person):
+        return self.overlap(person).keys()
+
+
+# Item-centric prefs shared by every worker of a parallel calculate_similar_items
+_worker_item_prefs = None
+
+
+def _init_similar_items_worker(item_prefs):
+    global _worker_item_prefs
+    _worker_item_prefs = item_prefs
+
+
+def _similar_items_worker(args):
+    item, n = args
+    return item, top_matches(_worker_item_prefs, item, n=n, similarity=sim_distance)
+
+
+def calculate_similar_items(prefs, n=10, processes=None):
     # Create a dictionary of items showing which other items they are most similar to
     result = {}
 
     # Invert the preference matrix to be item-centric
     item_prefs = transform_prefs(prefs)
+
+    if processes is not None and processes > 1:
+        # The item prefs are handed to each worker once when the pool starts,
+        # so a task only carries the item name
+        pool = Pool(processes, initializer=_init_similar_items_worker, initargs=(item_prefs,))
+        try:
+            chunksize = max(1, len(item_prefs) // (processes * 4))
+            tasks = [(item, n) for item in item_prefs]
+            for item, scores in pool.imap_unordered(_similar_items_worker, tasks, chunksize):
+                result[item] = scores
+        finally:
+            pool.close()
+            pool.join()
+        return result
+
     c = 0
     for item in item_prefs:
         # Status updates for large data set
         c += 1
         if c % 100 == 0:
-            print("%d / %d%", (c, len(item_prefs)))
+            print("%d / %d" % (c, len(item_prefs)))
         # Find the most similar item to this one
         scores = top_matches(item_prefs, item, n=n, similarity=sim_distance)
         result[item] = scores
@@ -193,18 +256,42 @@ def get_recommended_items(prefs, item_match, user):
     return rankings
 
 
-def load_movielens(path='/Users/rsuwandi/Personal/programming-collective-intelligence/chapter2/ml-100k'):
-    # Get movie titles
+# Movie titles by id from a MovieLens u.item file. With disambiguate, titles
+# that appear more than once get their movie id appended
+def load_titles(path, disambiguate=False):
+    rows = [line.split('|')[0:2] for line in open(os.path.join(path, 'u.item'), encoding='ISO-8859-1')]
+    seen = {}
+    for (id, title) in rows:
+        seen[title] = seen.get(title, 0) + 1
+
     movies = {}
-    for line in open(path + '/u.item', encoding='ISO-8859-1'):
-        (id, title) = line.split('|')[0:2]
-        movies[id] = title
+    for (id, title) in rows:
+        if disambiguate and seen[title] > 1:
+            movies[id] = '%s [%s]' % (title, id)
+        else:
+            movies[id] = title
+    return movies
 
-    # Load data
-    prefs = {}
-    for line in open(path + '/u.data'):
+
+# (user, title, rating) for every line of a MovieLens u.data style file
+def iter_ratings(lines, movies):
+    for line in lines:
         (user, movieid, rating, ts) = line.split('\t')
-        prefs.setdefault(user, {})
-        prefs[user][movies[movieid]] = float(rating)
+        yield user, movies[movieid], float(rating)
+
 
+def parse_ratings(lines, movies):
+    prefs = {}
+    for (user, title, rating) in iter_ratings(lines, movies):
+        prefs.setdefault(user, {})
+        prefs[user][title] = rating
     return prefs
+
+
+def load_movielens(path=os.path.join(os.path.dirname(os.path.abspath(__file__)), 'ml-100k')):
+    # Get movie titles
+    movies = load_titles(path)
+
+    # Load data
+    with open(os.path.join(path, 'u.data')) as f:
+        return parse_ratings(f, movies)
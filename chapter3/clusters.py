@@ -1,6 +1,13 @@
+from concurrent.futures import ThreadPoolExecutor
 from math import sqrt
+import json
+import os
 from PIL import Image, ImageDraw
+import numpy as np
 import random
+from xml.sax.saxutils import escape
+
+import distances
 
 
 def pearson(v1, v2):
@@ -21,6 +28,74 @@ def pearson(v1, v2):
     return 1.0 - num / den
 
 
+def tanimoto(v1, v2):
+    c1, c2, shared = 0, 0, 0
+    for i in range(len(v1)):
+        if v1[i] != 0:
+            c1 += 1
+        if v2[i] != 0:
+            c2 += 1
+        if v1[i] != 0 and v2[i] != 0:
+            shared += 1
+    if c1 + c2 - shared == 0:
+        return 0
+    return 1.0 - (float(shared) / (c1 + c2 - shared))
+
+
+# Distance functions with a vectorized equivalent in the distances module. The
+# algorithms below also accept a metric name ('pearson', 'euclidean',
+# 'tanimoto') as distance; any other function is called pair by pair
+batch_metrics = {pearson: 'pearson', tanimoto: 'tanimoto'}
+
+# Rows per tile of the vectorized distance computations. The algorithms take a
+# workers argument to spread the tiles over that many threads
+CHUNK_SIZE = 512
+
+
+def batch_metric(distance):
+    if isinstance(distance, str):
+        return distance
+    return batch_metrics.get(distance)
+
+
+# Distance from every row of a to every row of b (a to itself if b is None)
+def distance_matrix(a, b=None, distance=pearson, workers=None, chunk_size=None):
+    metric = batch_metric(distance)
+    if metric is not None:
+        return distances.cdist(a, b, metric, chunk_size or CHUNK_SIZE, workers)
+    if b is None:
+        b = a
+    return np.array([[distance(x, y) for y in b] for x in a])
+
+
+# All-pairs distances of rows as a condensed upper triangle
+def condensed_distances(rows, distance=pearson, workers=None, chunk_size=None):
+    metric = batch_metric(distance)
+    if metric is not None:
+        return distances.pdist(rows, metric, chunk_size or CHUNK_SIZE, workers)
+    n = len(rows)
+    result = np.empty(n * (n - 1) // 2)
+    k = 0
+    for i in range(n):
+        for j in range(i + 1, n):
+            result[k] = distance(rows[i], rows[j])
+            k += 1
+    return result
+
+
+# Values of one data row. Dense rows list every column, sparse rows (as written
+# by generatefeedvector.FeedVectorStore) only list column:value cells and have
+# no cells at all when every value is zero
+def parse_row(cells, ncols):
+    if not cells or ':' in cells[0]:
+        row = [0.0] * ncols
+        for cell in cells:
+            column, value = cell.split(':')
+            row[int(column)] = float(value)
+        return row
+    return [float(x) for x in cells]
+
+
 def readfile(filename):
     lines = [line for line in open(filename)]
 
@@ -29,17 +104,68 @@ def readfile(filename):
     rownames = []
     data = []
     for line in lines[1:]:
-        p = line.strip().split('\t')
+        p = line.rstrip('\r\n').split('\t')
 
         # First column is row name
-        rownames.append(p[0])
+        rownames.append(p[0].strip())
 
         # The data for this row is the remainder of the row
-        data.append([float(x) for x in p[1:]])
+        data.append(parse_row(p[1:], len(colnames)))
 
     return rownames, colnames, data
 
 
+# Convert a readfile() TSV into a binary .npy matrix plus a .labels.json file
+# with the row and column names. Rows are parsed one line at a time straight
+# into the memory-mapped output, so the whole TSV never sits in Python lists
+def build_matrix_cache(filename, cache_prefix=None):
+    if cache_prefix is None:
+        cache_prefix = filename
+
+    with open(filename) as f:
+        colnames = f.readline().strip().split('\t')[1:]
+        nrows = sum(1 for line in f if line.strip())
+
+    rownames = []
+    data = np.lib.format.open_memmap(cache_prefix + '.npy', mode='w+', dtype=np.float64,
+                                     shape=(nrows, len(colnames)))
+    with open(filename) as f:
+        f.readline()
+        i = 0
+        for line in f:
+            if not line.strip():
+                continue
+            p = line.rstrip('\r\n').split('\t')
+            rownames.append(p[0].strip())
+            data[i] = parse_row(p[1:], len(colnames))
+            i += 1
+    data.flush()
+    del data
+
+    with open(cache_prefix + '.labels.json', 'w') as f:
+        json.dump({'rownames': rownames, 'colnames': colnames}, f)
+
+
+# Same (rownames, colnames, data) as readfile, but data is a read-only memory
+# map of the binary cache, which is (re)built when missing or older than the TSV.
+# rotatematrix(data) on the result is a zero-copy transposed view
+def load_matrix(filename, cache_prefix=None):
+    if cache_prefix is None:
+        cache_prefix = filename
+    matrix_file = cache_prefix + '.npy'
+    labels_file = cache_prefix + '.labels.json'
+
+    fresh = (os.path.exists(matrix_file) and os.path.exists(labels_file) and
+             min(os.path.getmtime(matrix_file), os.path.getmtime(labels_file)) >=
+             os.path.getmtime(filename))
+    if not fresh:
+        build_matrix_cache(filename, cache_prefix)
+
+    with open(labels_file) as f:
+        labels = json.load(f)
+    return labels['rownames'], labels['colnames'], np.load(matrix_file, mmap_mode='r')
+
+
 class Bicluster:
     def __init__(self, vec, left=None, right=None, distance=0.0, id=None):
         self.left = left
@@ -49,118 +175,209 @@ class Bicluster:
         self.distance = distance
 
 
-def hcluster(rows, distance=pearson):
-    distances = {}
-    current_cluster_id = -1
+# Positions in a condensed (upper triangle) distance array for the pairs (i, j)
+# for every j in 0..n-1. The entry for j == i is meaningless and must be masked
+def condensed_indices(n, i):
+    j = np.arange(n)
+    lo = np.minimum(i, j)
+    hi = np.maximum(i, j)
+    return n * lo - lo * (lo + 1) // 2 + hi - lo - 1
 
-    # Clusters are initially just the rows
-    cluster = [Bicluster(rows[i], id=i) for i in range(len(rows))]
 
-    while len(cluster) > 1:
-        lowestpair = (0, 1)
-        closest = distance(cluster[0].vec, cluster[1].vec)
+def hcluster(rows, distance=pearson, workers=None):
+    n = len(rows)
 
-        # Loop through every pair looking for the smallest distance
-        for i in range(len(cluster)):
-            for j in range(i + 1, len(cluster)):
-                # distances is cached
-                if (cluster[i].id, cluster[j].id) not in distances:
-                    distances[(cluster[i].id, cluster[j].id)] = distance(cluster[i].vec, cluster[j].vec)
+    # Clusters are initially just the rows. Slot i holds the cluster that
+    # replaced row i, or None once it has been merged into another slot
+    cluster = [Bicluster(rows[i], id=i) for i in range(n)]
 
-                d = distances[(cluster[i].id, cluster[j].id)]
+    # Position each cluster would have in a list of the remaining clusters
+    # where merged clusters are appended at the end: rows by index, then merged
+    # clusters in creation order. The lower one becomes the left branch
+    rank = np.arange(n)
+    current_cluster_id = -1
+    if n == 1:
+        return cluster[0]
 
-                if d < closest:
-                    closest = d
-                    lowestpair = (i, j)
+    # Every pairwise distance is computed once into a condensed matrix
+    pair_dist = condensed_distances(rows, distance, workers)
+
+    active = np.ones(n, dtype=bool)
+    nearest = np.zeros(n, dtype=int)
+    nearest_dist = np.full(n, np.inf)
+
+    def find_nearest(i):
+        d = pair_dist[condensed_indices(n, i)]
+        d[~active] = np.inf
+        d[i] = np.inf
+        nearest[i] = np.argmin(d)
+        nearest_dist[i] = d[nearest[i]]
+
+    for i in range(n):
+        find_nearest(i)
+
+    for step in range(n - 1):
+        # The closest pair overall is the slot with the smallest nearest distance.
+        # Ties go to the pair that comes first in list order (by rank), like
+        # the pairwise scan of the original implementation
+        closest = nearest_dist.min()
+        best = None
+        for i in np.nonzero(nearest_dist == closest)[0]:
+            d = pair_dist[condensed_indices(n, i)]
+            for j in np.nonzero((d == closest) & active)[0]:
+                if j != i:
+                    key = (min(rank[i], rank[j]), max(rank[i], rank[j]))
+                    if best is None or key < best[0]:
+                        best = (key, int(i), int(j))
+        i, j = best[1], best[2]
+        a, b = min(i, j), max(i, j)
 
         # Calculate average of the two clusters
-        mergevec = [(cluster[lowestpair[0]].vec[i] + cluster[lowestpair[1]].vec[i]) / 2.0
-                    for i in range(len(cluster[0].vec))]
+        mergevec = [(cluster[a].vec[x] + cluster[b].vec[x]) / 2.0
+                    for x in range(len(cluster[a].vec))]
 
-        # Create new cluster
-        newcluster = Bicluster(mergevec, left=cluster[lowestpair[0]], right=cluster[lowestpair[1]], distance=closest,
+        # Create new cluster in the first slot and retire the second one
+        left, right = (a, b) if rank[a] < rank[b] else (b, a)
+        cluster[a] = Bicluster(mergevec, left=cluster[left], right=cluster[right], distance=closest,
                                id=current_cluster_id)
-
+        cluster[b] = None
+        rank[a] = n + step
         current_cluster_id -= 1
+        active[b] = False
+        nearest_dist[b] = np.inf
+
+        if step == n - 2:
+            break
 
-        del cluster[lowestpair[1]]
-        del cluster[lowestpair[0]]
-        cluster.append(newcluster)
+        # Distances from the new cluster to everything still active
+        others = np.nonzero(active)[0]
+        others = others[others != a]
+        idx = condensed_indices(n, a)
+        pair_dist[idx[others]] = distance_matrix([cluster[o].vec for o in others], [mergevec],
+                                                 distance)[:, 0]
 
-    return cluster[0]
+        # Anything that pointed at a or b has to look again, everything else
+        # only needs to check whether the new cluster is now closer
+        find_nearest(a)
+        for o in others:
+            if nearest[o] == a or nearest[o] == b:
+                find_nearest(o)
+            elif pair_dist[idx[o]] < nearest_dist[o]:
+                nearest[o] = a
+                nearest_dist[o] = pair_dist[idx[o]]
+
+    return cluster[int(np.nonzero(active)[0][0])]
 
 
 def print_cluster(cluster, labels=None, n=0):
-    for i in range(n):
-        print(' ')
-    if cluster.id < 0:
-        # Negative id == branch
-        print('-')
-    else:
-        # Positive id == endpoint
-        if labels is None:
-            print(cluster.id)
+    # Walk the tree with an explicit stack so deep trees don't hit the recursion limit
+    stack = [(cluster, n)]
+    while stack:
+        cluster, n = stack.pop()
+        if cluster.id < 0:
+            # Negative id == branch
+            name = '-'
+        elif labels is None:
+            # Positive id == endpoint
+            name = cluster.id
         else:
-            print(labels[cluster.id])
-
-    # Print right and left branches
-    if cluster.left is not None:
-        print_cluster(cluster.left, labels=labels, n=n + 1)
-    if cluster.right is not None:
-        print_cluster(cluster.right, labels=labels, n=n + 1)
+            name = labels[cluster.id]
+        print('%s%s' % (' ' * n, name))
+
+        # Print left and then right branches
+        if cluster.right is not None:
+            stack.append((cluster.right, n + 1))
+        if cluster.left is not None:
+            stack.append((cluster.left, n + 1))
+
+
+# Height (number of endpoints) and depth (distance to the deepest endpoint) of
+# every node in the tree, keyed by cluster id, computed in one post-order pass
+def tree_metrics(clust):
+    heights = {}
+    depths = {}
+    stack = [(clust, False)]
+    while stack:
+        node, children_done = stack.pop()
+        if node.left is None and node.right is None:
+            # An endpoint has height 1 and depth 0
+            heights[node.id] = 1
+            depths[node.id] = 0
+        elif children_done:
+            # A branch is as tall as both sides together and as deep as its
+            # deeper side plus its own distance
+            heights[node.id] = heights[node.left.id] + heights[node.right.id]
+            depths[node.id] = max(depths[node.left.id], depths[node.right.id]) + node.distance
+        else:
+            stack.append((node, True))
+            stack.append((node.right, False))
+            stack.append((node.left, False))
+    return heights, depths
 
 
 def get_height(clust):
-    # If this is an endpoint, then height is just 1
-    if clust.left is None and clust.right is None:
-        return 1
-
-    # Otherwise the height is the same of the heights of each branch
-    return get_height(clust.left) + get_height(clust.right)
+    return tree_metrics(clust)[0][clust.id]
 
 
 def get_depth(clust):
-    # The distance of an endpoint is 0
-    if clust.left is None and clust.right is None:
-        return 0
+    return tree_metrics(clust)[1][clust.id]
 
-    # The distance of a branch is the grater of its two sides plus its own distance
-    return max(get_depth(clust.left), get_depth(clust.right)) + clust.distance
 
+# Lines and labels of a dendogram as ('line', (x1, y1, x2, y2), colour) and
+# ('text', (x, y), label) tuples, generated without recursion
+def dendogram_shapes(clust, x, y, scaling, labels, heights=None):
+    if heights is None:
+        heights = tree_metrics(clust)[0]
 
-def draw_node(draw, clust, x, y, scaling, labels):
-    if clust.id < 0:
-        h1 = get_height(clust.left) * 20
-        h2 = get_height(clust.right) * 20
-        top = y - (h1 + h2) / 2
-        bottom = y + (h1 + h2) / 2
+    stack = [(clust, x, y)]
+    while stack:
+        clust, x, y = stack.pop()
+        if clust.id < 0:
+            h1 = heights[clust.left.id] * 20
+            h2 = heights[clust.right.id] * 20
+            top = y - (h1 + h2) / 2
+            bottom = y + (h1 + h2) / 2
 
-        line_len = clust.distance * scaling
+            line_len = clust.distance * scaling
 
-        # Vertical line from this cluster to children
-        draw.line((x, top + h1 / 2, x, bottom - h2 / 2), fill=(0, 255, 0))
+            # Vertical line from this cluster to children
+            yield 'line', (x, top + h1 / 2, x, bottom - h2 / 2), (0, 255, 0)
 
-        # Horizontal line to the left item
-        draw.line((x, top + h1 / 2, x + line_len, top + h1 / 2), fill=(255, 0, 0))
+            # Horizontal line to the left item
+            yield 'line', (x, top + h1 / 2, x + line_len, top + h1 / 2), (255, 0, 0)
 
-        # Horizontal line to the right item
-        draw.line((x, bottom - h2 / 2, x + line_len, bottom - h2 / 2), fill=(255, 0, 0))
+            # Horizontal line to the right item
+            yield 'line', (x, bottom - h2 / 2, x + line_len, bottom - h2 / 2), (255, 0, 0)
 
-        # Draw left and right nodes
-        draw_node(draw, clust.left, x + line_len, top + h1 / 2, scaling, labels)
-        draw_node(draw, clust.right, x + line_len, bottom - h2 / 2, scaling, labels)
-    else:
-        # Draw endpoint if this is an item label
-        draw.text((x + 5, y - 7), labels[clust.id], (0, 0, 0))
+            # Draw left and right nodes
+            stack.append((clust.right, x + line_len, bottom - h2 / 2))
+            stack.append((clust.left, x + line_len, top + h1 / 2))
+        else:
+            # Draw endpoint if this is an item label
+            yield 'text', (x + 5, y - 7), labels[clust.id]
 
 
-def draw_dendogram(clust, labels, jpeg='clusters.jpg'):
-    h = get_height(clust) * 20
-    w = 1200
-    depth = get_depth(clust)
+def draw_node(draw, clust, x, y, scaling, labels, heights=None):
+    for kind, position, value in dendogram_shapes(clust, x, y, scaling, labels, heights):
+        if kind == 'line':
+            draw.line(position, fill=value)
+        else:
+            draw.text(position, value, (0, 0, 0))
+
+
+def dendogram_size(clust, width):
+    heights, depths = tree_metrics(clust)
+    h = heights[clust.id] * 20
+    depth = depths[clust.id]
 
     # scale distance based on width
-    scaling = float(w - 150) / depth
+    scaling = float(width - 150) / depth if depth > 0 else 0
+    return h, scaling, heights
+
+
+def draw_dendogram(clust, labels, jpeg='clusters.jpg'):
+    w = 1200
+    h, scaling, heights = dendogram_size(clust, w)
 
     # Create new image with white bg
     img = Image.new('RGB', (w, h), (255, 255, 255))
@@ -168,11 +385,37 @@ def draw_dendogram(clust, labels, jpeg='clusters.jpg'):
     draw.line((0, h / 2, 10, h / 2), fill=(255, 0, 0))
 
     # Draw the first node
-    draw_node(draw, clust, 10, (h / 2), scaling, labels)
+    draw_node(draw, clust, 10, (h / 2), scaling, labels, heights)
     img.save(jpeg, 'JPEG')
 
 
+# Same drawing as draw_dendogram written as SVG. Shapes are streamed to the file
+# as they are generated, so the image never has to fit in memory. Coordinates
+# use a fixed format: %g keeps only 6 significant digits, which snaps tall
+# dendograms (a million pixels and more) to a 10 px grid
+def draw_dendogram_svg(clust, labels, svg='clusters.svg', width=1200):
+    h, scaling, heights = dendogram_size(clust, width)
+
+    with open(svg, 'w', encoding='utf-8') as out:
+        out.write('<svg xmlns="http://www.w3.org/2000/svg" width="%d" height="%d" '
+                  'font-family="sans-serif" font-size="11">\n' % (width, h))
+        out.write('<rect width="100%" height="100%" fill="white"/>\n')
+        out.write('<line x1="0" y1="%.1f" x2="10" y2="%.1f" stroke="rgb(255,0,0)"/>\n' % (h / 2, h / 2))
+        for kind, position, value in dendogram_shapes(clust, 10, h / 2, scaling, labels, heights):
+            if kind == 'line':
+                out.write('<line x1="%.1f" y1="%.1f" x2="%.1f" y2="%.1f" stroke="rgb(%d,%d,%d)"/>\n'
+                          % (position + value))
+            else:
+                out.write('<text x="%.1f" y="%.1f" dominant-baseline="hanging">%s</text>\n'
+                          % (position[0], position[1], escape(str(value))))
+        out.write('</svg>\n')
+
+
 def rotatematrix(data):
+    # numpy matrices (e.g. from load_matrix) just get a transposed view
+    if isinstance(data, np.ndarray):
+        return data.T
+
     newdata = []
     for i in range(len(data[0])):
         newrow = [data[j][i] for j in range(len(data))]
@@ -180,105 +423,253 @@ def rotatematrix(data):
     return newdata
 
 
-def kclusters(rows, distance=pearson, k=4):
-    # Determines min and max for each point
+# Pick k starting centroids with k-means++: each new centroid is a row chosen
+# with probability proportional to its squared distance to the nearest centroid
+# picked so far
+def kmeans_plus_plus(rows, k, distance=pearson, rng=random, workers=None):
+    rows = np.asarray(rows, dtype=np.float64)
+    centroids = [rows[rng.randrange(len(rows))]]
+    nearest = distance_matrix(rows, centroids, distance, workers)[:, 0]
+    for i in range(1, k):
+        weights = np.maximum(nearest, 0) ** 2
+        total = weights.sum()
+        if total > 0:
+            choice = int(np.searchsorted(np.cumsum(weights), rng.random() * total, side='right'))
+            choice = min(choice, len(rows) - 1)
+        else:
+            choice = rng.randrange(len(rows))
+        centroids.append(rows[choice])
+        nearest = np.minimum(nearest, distance_matrix(rows, [rows[choice]], distance, workers)[:, 0])
+    return np.array(centroids)
 
-    ranges = [(min([row[i] for row in rows]), max([row[i] for row in rows]))
-              for i in range(len(rows[0]))]
 
-    # Create k randomly placed centroids
-    clusters = [[random.random() * (ranges[i][1] - ranges[i][0]) + ranges[i][0]
-                 for i in range(len(rows[0]))]
-                for j in range(k)]
+def group_matches(closest, k):
+    bestmatches = [[] for i in range(k)]
+    for j, c in enumerate(closest.tolist()):
+        bestmatches[c].append(j)
+    return bestmatches
 
-    lastmatches = None
-    # bestmatches = None
-    for t in range(1):
-        print('Iteration {0}'.format(t))
-        bestmatches = [[] for i in range(k)]
 
+# Move every centroid to the average of its members, empty clusters stay put
+def move_centroids(rows, closest, centroids):
+    sums = np.zeros_like(centroids)
+    np.add.at(sums, closest, rows)
+    counts = np.bincount(closest, minlength=len(centroids))
+    moved = centroids.copy()
+    filled = counts > 0
+    moved[filled] = sums[filled] / counts[filled][:, np.newaxis]
+    return moved
+
+
+# One k-means run, returns (total distance to centroids, assignment of each row)
+def kmeans_run(rows, distance, k, max_iter, tol, seed, workers=None):
+    rng = random.Random(seed)
+    centroids = kmeans_plus_plus(rows, k, distance, rng, workers)
+
+    lastmatches = None
+    for t in range(max_iter):
         # Find which centroids closet to each row
-        for j in range(len(rows)):
-            row = rows[j]
-            bestmatch = 0
-            for i in range(k):
-                d = distance(clusters[i], row)
-                if d < distance(clusters[bestmatch], row):
-                    bestmatch = i
-            bestmatches[bestmatch].append(j)
+        d = distance_matrix(rows, centroids, distance, workers)
+        closest = np.argmin(d, axis=1)
 
         # If result is the same as last time, this is complete
-        if bestmatches == lastmatches:
+        if lastmatches is not None and np.array_equal(closest, lastmatches):
+            break
+        lastmatches = closest
+
+        moved = move_centroids(rows, closest, centroids)
+        shift = np.abs(moved - centroids).max()
+        centroids = moved
+        if shift <= tol:
+            d = distance_matrix(rows, centroids, distance, workers)
+            closest = np.argmin(d, axis=1)
             break
-        lastmatches = bestmatches
-
-        # Move the centroids to the average of their members
-        for i in range(k):
-            avgs = [0.0] * len(rows[0])
-            if len(bestmatches[i]) > 0:
-                for rowid in bestmatches[i]:
-                    for m in range(len(rows[rowid])):
-                        avgs[m] += rows[rowid][m]
-                for j in range(len(avgs)):
-                    avgs[j] /= len(bestmatches[i])
-                clusters[i] = avgs
 
-    return bestmatches
+    return d[np.arange(len(rows)), closest].sum(), closest
+
 
+# k-means with k-means++ seeding. Runs until the assignments stop changing, the
+# centroids move less than tol or max_iter is reached. With n_init > 1 several
+# seeded runs are made and the one with the smallest total distance wins. With
+# workers > 1 the runs are spread over that many threads, or with a single run
+# its distance tiles are
+def kclusters(rows, distance=pearson, k=4, max_iter=100, tol=1e-4, n_init=1, workers=None,
+              seed=None):
+    rows = np.asarray(rows, dtype=np.float64)
+    seeds = random.Random(seed).sample(range(2 ** 30), n_init)
 
-def scaledown(data, distance=pearson, rate=0.01):
+    if workers is not None and workers > 1 and n_init > 1:
+        with ThreadPoolExecutor(workers) as pool:
+            runs = list(pool.map(lambda s: kmeans_run(rows, distance, k, max_iter, tol, s), seeds))
+    else:
+        runs = [kmeans_run(rows, distance, k, max_iter, tol, s, workers) for s in seeds]
+
+    best_error, closest = min(runs, key=lambda run: run[0])
+    return group_matches(closest, k)
+
+
+# Mini-batch k-means for matrices too large to hold in memory, such as a numpy
+# memmap: rows only needs len() and slicing. Centroids are updated from one
+# batch_size block at a time, each with a per-centroid learning rate of
+# 1 / (rows assigned so far), and a final pass assigns every row
+def minibatch_kclusters(rows, distance=pearson, k=4, batch_size=1000, passes=3, seed=None,
+                        workers=None):
+    rng = random.Random(seed)
+    n = len(rows)
+    starts = list(range(0, n, batch_size))
+
+    first_start = rng.choice(starts)
+    first = np.asarray(rows[first_start:first_start + batch_size], dtype=np.float64)
+    centroids = kmeans_plus_plus(first, k, distance, rng, workers)
+    counts = np.zeros(k)
+
+    for p in range(passes):
+        rng.shuffle(starts)
+        for start in starts:
+            batch = np.asarray(rows[start:start + batch_size], dtype=np.float64)
+            closest = np.argmin(distance_matrix(batch, centroids, distance, workers), axis=1)
+
+            sums = np.zeros_like(centroids)
+            np.add.at(sums, closest, batch)
+            assigned = np.bincount(closest, minlength=k)
+            counts += assigned
+
+            filled = assigned > 0
+            centroids[filled] += ((sums[filled] - assigned[filled][:, np.newaxis] * centroids[filled])
+                                  / counts[filled][:, np.newaxis])
+
+    closest = np.concatenate([
+        np.argmin(distance_matrix(np.asarray(rows[start:start + batch_size], dtype=np.float64),
+                                  centroids, distance, workers), axis=1)
+        for start in range(0, n, batch_size)])
+    return group_matches(closest, k)
+
+
+# Pairwise euclidean distances between the rows of loc, written into out (an
+# n x n float64 array) when given instead of a new array
+def layout_distances(loc, out=None):
+    sq = (loc ** 2).sum(axis=1)
+    d = np.dot(loc, loc.T, out=out)
+    d *= -2
+    d += sq[:, np.newaxis]
+    d += sq[np.newaxis, :]
+    np.maximum(d, 0, out=d)
+    np.sqrt(d, out=d)
+    np.fill_diagonal(d, 0)
+    return d
+
+
+# Multidimensional scaling of data into 2-D. The default 'gradient' method moves
+# every point along the gradient of the summed percentage error between the
+# layout and the real distances. The first step is rate times the gradient,
+# every step that lowers the error makes the next one 10% longer, and a step
+# that makes the error worse is undone and retried at half the length (so a
+# rate that is too large for many points only costs a few halvings). The search stops once the error improves by less than tol
+# (relative). method='smacof' uses stress majorization instead, with
+# smacof's own max_iter and tol unless given. callback(iteration, error) is
+# called after every iteration if given
+def scaledown(data, distance=pearson, rate=0.01, max_iter=None, tol=None, callback=None,
+              method='gradient', workers=None):
     n = len(data)
 
     # Real distance between every pair of items
-    real_dist = [[distance(data[i], data[j]) for j in range(n)]
-                 for i in range(0, n)]
-
-    outersum = 0.0
+    real_dist = distance_matrix(data, distance=distance, workers=workers)
+    np.maximum(real_dist, 1e-12, out=real_dist)
 
     # Randomly initialize starting points
-    loc = [[random.random(), random.random()] for i in range(n)]
-    fake_dist = [[0.0 for j in range(n)] for i in range(n)]
+    loc = np.array([[random.random(), random.random()] for i in range(n)])
+
+    if method == 'smacof':
+        np.fill_diagonal(real_dist, 0)
+        options = dict((name, value) for name, value in (('max_iter', max_iter), ('tol', tol))
+                       if value is not None)
+        return smacof(real_dist, loc, callback=callback, **options).tolist()
+    if method != 'gradient':
+        raise ValueError('Unknown scaledown method %r' % (method,))
+    if max_iter is None:
+        max_iter = 1000
+    if tol is None:
+        tol = 1e-6
+
+    # The diagonal is never used, 1 just keeps the division below finite
+    np.fill_diagonal(real_dist, 1.0)
+
+    # The two n x n work arrays are reused by every iteration
+    fake_dist = np.empty((n, n))
+    errorterm = np.empty((n, n))
 
     lasterror = None
-    for m in range(0, 1000):
+    lastloc = loc
+    step = rate
+    for m in range(max_iter):
         # Find projected distance
-        for i in range(n):
-            for j in range(n):
-                fake_dist[i][j] = sqrt(sum([pow(loc[i][x] - loc[j][x], 2)
-                                            for x in range(len(loc[i]))]))
-
-        # Move points
-        grad = [[0.0, 0.0] for i in range(n)]
-
-        totalerror = 0
-        for k in range(n):
-            for j in range(n):
-                if j == k:
-                    continue
-
-                # Error is percent diff between distances
-                errorterm = (fake_dist[j][k] - real_dist[j][k]) / real_dist[j][k]
-
-                # Each points needs to be moved away from or towards the other point in proportion to how much error
-                # it has
-                grad[k][0] += ((loc[k][0] - loc[j][0]) / fake_dist[j][k]) * errorterm
-                grad[k][1] += ((loc[k][1] - loc[j][1]) / fake_dist[j][k]) * errorterm
-
-                # Keep track of total error
-                totalerror += abs(errorterm)
-
-        print(totalerror)
-
-        # If answer got worse by moving the points, we are done
-        if lasterror and lasterror < totalerror:
+        layout_distances(loc, out=fake_dist)
+        np.maximum(fake_dist, 1e-12, out=fake_dist)
+
+        # Error is percent diff between distances
+        np.subtract(fake_dist, real_dist, out=errorterm)
+        errorterm /= real_dist
+        np.fill_diagonal(errorterm, 0)
+
+        # Each points needs to be moved away from or towards the other point in proportion to how much error
+        # it has
+        weights = np.divide(errorterm, fake_dist, out=fake_dist)
+        grad = loc * weights.sum(axis=0)[:, np.newaxis] - weights.T.dot(loc)
+
+        # Keep track of total error
+        totalerror = np.abs(errorterm, out=errorterm).sum()
+        if callback is not None:
+            callback(m, totalerror)
+
+        # If answer got worse by moving the points, go back and take smaller steps
+        if lasterror is not None and lasterror < totalerror:
+            loc = lastloc
+            step /= 2
+            if step < 1e-6 * rate:
+                break
+            loc = lastloc - step * lastgrad
+            continue
+        if lasterror is not None and lasterror - totalerror <= tol * lasterror:
             break
 
         lasterror = totalerror
+        lastloc = loc
+        lastgrad = grad
 
         # Move each points by the learning rate times the gradient
-        for k in range(n):
-            loc[k][0] -= rate * grad[k][0]
-            loc[k][1] -= rate * grad[k][1]
+        loc = loc - step * grad
+        step *= 1.1
+
+    return lastloc.tolist()
+
+
+# Stress majorization (SMACOF) with unit weights: every iteration replaces the
+# layout with the Guttman transform B(loc) loc / n, which never increases the
+# stress (sum of squared differences between layout and real distances)
+def smacof(real_dist, loc, max_iter=300, tol=1e-4, callback=None):
+    n = len(real_dist)
+
+    # The two n x n work arrays are reused by every iteration
+    fake_dist = np.empty((n, n))
+    b = np.empty((n, n))
+
+    laststress = None
+    for m in range(max_iter):
+        layout_distances(loc, out=fake_dist)
+        np.subtract(fake_dist, real_dist, out=b)
+        stress = np.vdot(b, b) / 2
+        if callback is not None:
+            callback(m, stress)
+        if laststress is not None and laststress - stress <= tol * laststress:
+            break
+        laststress = stress
+
+        b.fill(0)
+        np.divide(real_dist, fake_dist, out=b, where=fake_dist > 0)
+        b *= -1
+        np.fill_diagonal(b, 0)
+        np.fill_diagonal(b, -b.sum(axis=1))
+        loc = b.dot(loc) / n
 
     return loc
 
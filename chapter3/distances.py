@@ -0,0 +1,146 @@
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+
+# Vectorized versions of the distance functions used by clusters.py, computed
+# over whole data matrices a tile at a time. Tiles bound the size of the
+# intermediate arrays and are spread over a thread pool (the heavy lifting is
+# numpy, which releases the GIL). The data matrix itself is never copied: the
+# prepare functions only keep per-row values, and each tile is centred or
+# converted inside the kernel.
+
+# fn applied to chunk_size rows at a time, concatenated
+def _per_row(x, fn, chunk_size):
+    if len(x) == 0:
+        return np.zeros(0)
+    return np.concatenate([fn(x[i:i + chunk_size]) for i in range(0, len(x), chunk_size)])
+
+
+def _pearson_prepare(x, chunk_size):
+    means = _per_row(x, lambda rows: rows.mean(axis=1), chunk_size)
+    norms = _per_row(x, lambda rows: np.sqrt(((rows - rows.mean(axis=1)[:, np.newaxis]) ** 2)
+                                             .sum(axis=1)), chunk_size)
+    return x, means, norms
+
+
+def _pearson_kernel(a, b):
+    x, mean_a, norm_a = a
+    y, mean_b, norm_b = b
+    den = norm_a[:, np.newaxis] * norm_b[np.newaxis, :]
+    num = (x - mean_a[:, np.newaxis]).dot((y - mean_b[:, np.newaxis]).T)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        d = 1.0 - num / den
+
+    # clusters.pearson returns 0 when either row has no variance
+    d[den == 0] = 0
+    return d
+
+
+def _euclidean_prepare(x, chunk_size):
+    return x, _per_row(x, lambda rows: (rows ** 2).sum(axis=1), chunk_size)
+
+
+def _euclidean_kernel(a, b):
+    x, sq_a = a
+    y, sq_b = b
+    d = sq_a[:, np.newaxis] + sq_b[np.newaxis, :] - 2 * x.dot(y.T)
+    return np.sqrt(np.maximum(d, 0))
+
+
+def _tanimoto_prepare(x, chunk_size):
+    return x, _per_row(x, lambda rows: (rows != 0).sum(axis=1).astype(np.float64), chunk_size)
+
+
+def _tanimoto_kernel(a, b):
+    x, count_a = a
+    y, count_b = b
+    shared = (x != 0).astype(np.float64).dot((y != 0).astype(np.float64).T)
+    union = count_a[:, np.newaxis] + count_b[np.newaxis, :] - shared
+    with np.errstate(divide='ignore', invalid='ignore'):
+        d = 1.0 - shared / union
+    d[union == 0] = 0
+    return d
+
+
+metrics = {'pearson': (_pearson_prepare, _pearson_kernel),
+           'euclidean': (_euclidean_prepare, _euclidean_kernel),
+           'tanimoto': (_tanimoto_prepare, _tanimoto_kernel)}
+
+
+def _slice(prepared, start, stop):
+    return tuple(p[start:stop] for p in prepared)
+
+
+def _run(tasks, workers):
+    if workers is None or workers <= 1:
+        for task in tasks:
+            task()
+        return
+    with ThreadPoolExecutor(workers) as pool:
+        for future in [pool.submit(task) for task in tasks]:
+            future.result()
+
+
+# Distance from every row of a to every row of b (or of a to itself)
+def cdist(a, b=None, metric='pearson', chunk_size=512, workers=None):
+    prepare, kernel = metrics[metric]
+    a = np.asarray(a, dtype=np.float64)
+    prepared_a = prepare(a, chunk_size)
+    if b is None:
+        b, prepared_b = a, prepared_a
+    else:
+        b = np.asarray(b, dtype=np.float64)
+        prepared_b = prepare(b, chunk_size)
+
+    out = np.empty((len(a), len(b)))
+
+    def tile(i, j):
+        def task():
+            out[i:i + chunk_size, j:j + chunk_size] = kernel(
+                _slice(prepared_a, i, i + chunk_size), _slice(prepared_b, j, j + chunk_size))
+        return task
+
+    _run([tile(i, j) for i in range(0, len(a), chunk_size) for j in range(0, len(b), chunk_size)],
+         workers)
+    return out
+
+
+# All-pairs distances of the rows of a as a condensed upper triangle, in the
+# order (0, 1), (0, 2), ..., (0, n-1), (1, 2), ...
+def pdist(a, metric='pearson', chunk_size=512, workers=None):
+    prepare, kernel = metrics[metric]
+    a = np.asarray(a, dtype=np.float64)
+    prepared = prepare(a, chunk_size)
+    n = len(a)
+    out = np.empty(n * (n - 1) // 2)
+
+    def block(i):
+        def task():
+            stop = min(i + chunk_size, n)
+            # Row r's entries (r, r + 1) ... (r, n - 1) start at n * r - r * (r + 1) / 2
+            for j in range(i, n, chunk_size):
+                j_stop = min(j + chunk_size, n)
+                d = kernel(_slice(prepared, i, stop), _slice(prepared, j, j_stop))
+                for r in range(i, stop):
+                    first = max(j, r + 1)
+                    if first >= j_stop:
+                        continue
+                    start = n * r - r * (r + 1) // 2 + first - r - 1
+                    out[start:start + j_stop - first] = d[r - i, first - j:]
+        return task
+
+    _run([block(i) for i in range(0, n, chunk_size)], workers)
+    return out
+
+
+def pearson_matrix(a, b=None, chunk_size=512, workers=None):
+    return cdist(a, b, 'pearson', chunk_size, workers)
+
+
+def euclidean_matrix(a, b=None, chunk_size=512, workers=None):
+    return cdist(a, b, 'euclidean', chunk_size, workers)
+
+
+def tanimoto_matrix(a, b=None, chunk_size=512, workers=None):
+    return cdist(a, b, 'tanimoto', chunk_size, workers)
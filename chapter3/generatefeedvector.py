@@ -1,11 +1,44 @@
 import feedparser
-import re
+import os
+import sqlite3
+import sys
+import time
+import urllib.error
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from tokenizer import feed_words
 
-# Returns title and dictionary of word counts for an RSS feed
-def get_word_counts(url):
+FEEDLIST = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'feedlist.txt')
+OUTPUT = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'blogdata-generated.txt')
+
+
+# Raw bytes of a feed from a URL or a local file. Connection errors, timeouts
+# and 5xx responses are retried with exponential backoff, other HTTP errors
+# (404, 410, ...) are raised straight away
+def fetch(url, timeout=10, retries=2, backoff=0.5):
+    if os.path.exists(url):
+        with open(url, 'rb') as f:
+            return f.read()
+
+    for attempt in range(retries + 1):
+        try:
+            with urllib.request.urlopen(url, timeout=timeout) as response:
+                return response.read()
+        except urllib.error.HTTPError as e:
+            if e.code < 500 or attempt == retries:
+                raise
+        except OSError:
+            if attempt == retries:
+                raise
+        time.sleep(backoff * 2 ** attempt)
+
+
+# Returns title and dictionary of word counts for already fetched feed content
+def parse_word_counts(content):
     # Parse feed
-    d = feedparser.parse(url)
+    d = feedparser.parse(content)
     wc = {}
 
     for e in d.entries:
@@ -14,57 +47,169 @@ def get_word_counts(url):
         else:
             summary = e.description
 
-        words = get_words(e.title + ' ' + summary)
-        for word in words:
+        for word in feed_words(e.title + ' ' + summary):
             wc.setdefault(word, 0)
             wc[word] += 1
 
     return d.feed.title, wc
 
 
+# Returns title and dictionary of word counts for an RSS feed
+def get_word_counts(url, timeout=10, retries=2):
+    return parse_word_counts(fetch(url, timeout=timeout, retries=retries))
+
+
+# Lowercase words of html with the tags removed, split on all non-alpha characters
 def get_words(html):
-    # Remove HTML tags
-    txt = re.compile(r'<[^>]+>').sub('', html)
-
-    # Split words by all non-alpha characters
-    words = re.compile(r'[^A-Z^a-z]+').split(txt)
-
-    # Convert to lowercase
-    return [word.lower() for word in words if word != '']
-
-
-apcount = {}
-wordcounts = {}
-feedlist = []
-for feedurl in open('/Users/rsuwandi/Personal/programming-collective-intelligence/chapter3/feedlist.txt'):
-    feedlist.append(feedurl)
-    title, wc = get_word_counts(feedurl)
-    wordcounts[title] = wc
-    for word, count in wc.items():
-        apcount.setdefault(word, 0)
-        if count > 1:
-            apcount[word] += 1
-
-wordlist = []
-for w, bc in apcount.items():
-    frac = float(bc) / len(feedlist)
-    if frac > 0.1 and frac < 0.5:
-        wordlist.append(w)
-
-out = open('/Users/rsuwandi/Personal/programming-collective-intelligence/chapter3/blogdata-generated.txt', 'w')
-out.write('Blog')
-
-for word in wordlist:
-    out.write('\t%s' % word)
-
-out.write('\n')
-for blog, wc in wordcounts.items():
-    # Deal with unicode outside ascii range
-    blog = blog.encode('ascii', 'ignore')
-    out.write(str(blog))
-    for word in wordlist:
-        if word in wc:
-            out.write('\t%d' % wc[word])
+    return list(feed_words(html))
+
+
+# Fetch and count many feeds at once with at most `workers` requests in flight.
+# Yields (url, title, wordcounts) as each feed finishes, feeds that still fail
+# after the retries are reported and skipped
+def fetch_word_counts(urls, workers=8, timeout=10, retries=2):
+    with ThreadPoolExecutor(workers) as pool:
+        futures = dict((pool.submit(get_word_counts, url, timeout, retries), url) for url in urls)
+        for future in as_completed(futures):
+            url = futures[future]
+            try:
+                title, wc = future.result()
+            except Exception as e:
+                print('Could not parse %s: %s' % (url, e))
+                continue
+            yield url, title, wc
+
+
+def read_feedlist(filename=FEEDLIST):
+    return [line.strip() for line in open(filename) if line.strip()]
+
+
+# Build the blog/word matrix for every feed in feedlist and write it to out
+def build_blogdata(feedlist=FEEDLIST, out=OUTPUT, workers=8, timeout=10, retries=2):
+    urls = read_feedlist(feedlist)
+
+    apcount = {}
+    wordcounts = {}
+    for url, title, wc in fetch_word_counts(urls, workers, timeout, retries):
+        wordcounts[title] = wc
+        for word, count in wc.items():
+            apcount.setdefault(word, 0)
+            if count > 1:
+                apcount[word] += 1
+
+    wordlist = []
+    for w, bc in apcount.items():
+        frac = float(bc) / len(urls)
+        if frac > 0.1 and frac < 0.5:
+            wordlist.append(w)
+
+    with open(out, 'w') as f:
+        f.write('Blog')
+        for word in wordlist:
+            f.write('\t%s' % word)
+        f.write('\n')
+
+        for blog, wc in wordcounts.items():
+            # Deal with unicode outside ascii range
+            blog = blog.encode('ascii', 'ignore').decode('ascii')
+            f.write(blog)
+            for word in wordlist:
+                if word in wc:
+                    f.write('\t%d' % wc[word])
+                else:
+                    f.write('\t0')
+            f.write('\n')
+
+    return wordcounts, wordlist
+
+
+# Persistent word counts and document frequencies for an ever growing set of
+# feeds. Adding feeds only touches their own rows and the apcount of their
+# words, and write_sparse emits the blog/word matrix in the sparse format
+# clusters.readfile understands (name followed by column:count cells)
+class FeedVectorStore:
+    def __init__(self, dbname):
+        self.con = sqlite3.connect(dbname)
+        self.con.execute('create table if not exists feeds(title text primary key)')
+        self.con.execute('create table if not exists words(word text primary key, apcount integer)')
+        self.con.execute('create table if not exists counts(feedid integer, wordid integer, count integer)')
+        self.con.execute('create index if not exists countfeedidx on counts(feedid)')
+        self.con.commit()
+
+    def close(self):
+        self.con.close()
+
+    def feed_count(self):
+        return self.con.execute('select count(1) from feeds').fetchone()[0]
+
+    def word_ids(self, words):
+        self.con.executemany('insert or ignore into words(word, apcount) values (?, 0)',
+                             [(w,) for w in words])
+        ids = {}
+        words = list(words)
+        for i in range(0, len(words), 500):
+            chunk = words[i:i + 500]
+            cur = self.con.execute('select word, rowid from words where word in (%s)'
+                                   % ','.join('?' * len(chunk)), chunk)
+            ids.update(cur.fetchall())
+        return ids
+
+    # Add a feed's word counts, replacing the counts stored for the same title
+    def add_feed(self, title, wc):
+        self.store_feed(title, wc)
+        self.con.commit()
+
+    # add_feed without the commit, for adding many feeds in one transaction
+    def store_feed(self, title, wc):
+        row = self.con.execute('select rowid from feeds where title = ?', (title,)).fetchone()
+        if row is None:
+            feedid = self.con.execute('insert into feeds(title) values (?)', (title,)).lastrowid
         else:
-            out.write('\t0')
-    out.write('\n')
+            feedid = row[0]
+            self.con.execute('update words set apcount = apcount - 1 where rowid in '
+                             '(select wordid from counts where feedid = ? and count > 1)', (feedid,))
+            self.con.execute('delete from counts where feedid = ?', (feedid,))
+
+        ids = self.word_ids(wc.keys())
+        self.con.executemany('insert into counts(feedid, wordid, count) values (?, ?, ?)',
+                             [(feedid, ids[w], c) for w, c in wc.items()])
+        self.con.executemany('update words set apcount = apcount + 1 where rowid = ?',
+                             [(ids[w],) for w, c in wc.items() if c > 1])
+
+    def add_feeds(self, urls, workers=8, timeout=10, retries=2):
+        for url, title, wc in fetch_word_counts(urls, workers, timeout, retries):
+            self.store_feed(title, wc)
+        self.con.commit()
+
+    # Words that appear (more than once) in between low and high of all feeds
+    def wordlist(self, low=0.1, high=0.5):
+        total = self.feed_count()
+        if total == 0:
+            return []
+        return self.con.execute('select rowid, word from words where apcount > ? and apcount < ? '
+                                'order by rowid', (low * total, high * total)).fetchall()
+
+    def write_sparse(self, out, low=0.1, high=0.5):
+        wordlist = self.wordlist(low, high)
+        columns = dict((wordid, i) for i, (wordid, word) in enumerate(wordlist))
+
+        with open(out, 'w') as f:
+            f.write('Blog')
+            for wordid, word in wordlist:
+                f.write('\t%s' % word)
+            f.write('\n')
+
+            for feedid, title in self.con.execute('select rowid, title from feeds order by rowid'):
+                f.write(title.encode('ascii', 'ignore').decode('ascii'))
+                cells = sorted((columns[wordid], count) for wordid, count in self.con.execute(
+                    'select wordid, count from counts where feedid = ?', (feedid,))
+                    if wordid in columns)
+                for column, count in cells:
+                    f.write('\t%d:%d' % (column, count))
+                f.write('\n')
+
+        return len(wordlist)
+
+
+if __name__ == '__main__':
+    build_blogdata()
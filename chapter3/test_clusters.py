@@ -0,0 +1,81 @@
+import os
+import random
+import unittest
+
+import clusters
+
+BLOGDATA = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'blogdata.txt')
+
+
+# The original list based hcluster, kept as the reference for the tree shape
+def reference_hcluster(rows, distance=clusters.pearson):
+    distances = {}
+    current_cluster_id = -1
+    cluster = [clusters.Bicluster(rows[i], id=i) for i in range(len(rows))]
+
+    while len(cluster) > 1:
+        lowestpair = (0, 1)
+        closest = distance(cluster[0].vec, cluster[1].vec)
+        for i in range(len(cluster)):
+            for j in range(i + 1, len(cluster)):
+                if (cluster[i].id, cluster[j].id) not in distances:
+                    distances[(cluster[i].id, cluster[j].id)] = distance(cluster[i].vec, cluster[j].vec)
+                d = distances[(cluster[i].id, cluster[j].id)]
+                if d < closest:
+                    closest = d
+                    lowestpair = (i, j)
+
+        mergevec = [(cluster[lowestpair[0]].vec[i] + cluster[lowestpair[1]].vec[i]) / 2.0
+                    for i in range(len(cluster[0].vec))]
+        newcluster = clusters.Bicluster(mergevec, left=cluster[lowestpair[0]],
+                                        right=cluster[lowestpair[1]], distance=closest,
+                                        id=current_cluster_id)
+        current_cluster_id -= 1
+        del cluster[lowestpair[1]]
+        del cluster[lowestpair[0]]
+        cluster.append(newcluster)
+
+    return cluster[0]
+
+
+# (id, left id, right id, distance) of every node, depth first from the left
+def tree_nodes(clust):
+    nodes = []
+    stack = [clust]
+    while stack:
+        node = stack.pop()
+        if node.left is None:
+            nodes.append((node.id, None, None, 0.0))
+        else:
+            nodes.append((node.id, node.left.id, node.right.id, round(node.distance, 9)))
+            stack.append(node.right)
+            stack.append(node.left)
+    return nodes
+
+
+class HclusterTest(unittest.TestCase):
+    def assert_same_tree(self, rows, distance=clusters.pearson):
+        self.assertEqual(tree_nodes(clusters.hcluster(rows, distance)),
+                         tree_nodes(reference_hcluster(rows, distance)))
+
+    def test_blogs(self):
+        blognames, words, data = clusters.readfile(BLOGDATA)
+        self.assert_same_tree(data[:40])
+
+    def test_words(self):
+        blognames, words, data = clusters.readfile(BLOGDATA)
+        self.assert_same_tree(clusters.rotatematrix(data)[:60])
+
+    def test_random_rows(self):
+        rng = random.Random(0)
+        rows = [[rng.random() for j in range(12)] for i in range(50)]
+        self.assert_same_tree(rows)
+        self.assert_same_tree(rows, clusters.tanimoto)
+
+    def test_single_row(self):
+        clust = clusters.hcluster([[1.0, 2.0]])
+        self.assertEqual((clust.id, clust.left, clust.right), (0, None, None))
+
+
+if __name__ == '__main__':
+    unittest.main()
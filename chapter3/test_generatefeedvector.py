@@ -0,0 +1,183 @@
+import os
+import shutil
+import tempfile
+import threading
+import unittest
+import urllib.error
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import numpy as np
+
+import clusters
+import generatefeedvector
+
+TESTDATA = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'testdata')
+
+
+# Local stand-in for the feed servers: /<name>.xml serves a fixture feed,
+# /slow never answers in time, /flaky fails with a 503 on its first request
+# and /gone is a 404. Every request is counted per path
+class FeedHandler(BaseHTTPRequestHandler):
+    hits = {}
+    release = threading.Event()
+
+    def do_GET(self):
+        hits = FeedHandler.hits
+        hits[self.path] = hits.get(self.path, 0) + 1
+
+        if self.path == '/slow':
+            FeedHandler.release.wait(2)
+            self.reply(200, b'')
+        elif self.path == '/gone':
+            self.reply(404, b'gone')
+        elif self.path == '/flaky' and hits[self.path] == 1:
+            self.reply(503, b'busy')
+        else:
+            name = 'python.xml' if self.path == '/flaky' else os.path.basename(self.path)
+            filename = os.path.join(TESTDATA, name)
+            if not os.path.exists(filename):
+                self.reply(404, b'missing')
+                return
+            with open(filename, 'rb') as f:
+                self.reply(200, f.read())
+
+    def reply(self, code, body):
+        try:
+            self.send_response(code)
+            self.send_header('Content-Type', 'application/rss+xml')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+        except OSError:
+            # The client gave up (timeout tests)
+            pass
+
+    def log_message(self, format, *args):
+        pass
+
+
+class GenerateFeedVectorTest(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.server = ThreadingHTTPServer(('127.0.0.1', 0), FeedHandler)
+        cls.base = 'http://127.0.0.1:%d' % cls.server.server_port
+        cls.thread = threading.Thread(target=cls.server.serve_forever)
+        cls.thread.daemon = True
+        cls.thread.start()
+
+    @classmethod
+    def tearDownClass(cls):
+        FeedHandler.release.set()
+        cls.server.shutdown()
+        cls.server.server_close()
+
+    def setUp(self):
+        FeedHandler.hits.clear()
+        self.tmp = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def test_fetch_local_file(self):
+        filename = os.path.join(TESTDATA, 'python.xml')
+        with open(filename, 'rb') as f:
+            self.assertEqual(generatefeedvector.fetch(filename), f.read())
+
+    def test_fetch_url(self):
+        with open(os.path.join(TESTDATA, 'cooking.xml'), 'rb') as f:
+            self.assertEqual(generatefeedvector.fetch(self.base + '/cooking.xml'), f.read())
+
+    def test_fetch_timeout(self):
+        with self.assertRaises(OSError):
+            generatefeedvector.fetch(self.base + '/slow', timeout=0.2, retries=1, backoff=0)
+        self.assertEqual(FeedHandler.hits['/slow'], 2)
+
+    def test_fetch_retries_server_errors(self):
+        content = generatefeedvector.fetch(self.base + '/flaky', retries=2, backoff=0)
+        self.assertIn(b'Python Notes', content)
+        self.assertEqual(FeedHandler.hits['/flaky'], 2)
+
+    def test_fetch_does_not_retry_client_errors(self):
+        with self.assertRaises(urllib.error.HTTPError) as raised:
+            generatefeedvector.fetch(self.base + '/gone', retries=2, backoff=0)
+        self.assertEqual(raised.exception.code, 404)
+        self.assertEqual(FeedHandler.hits['/gone'], 1)
+
+    def test_fetch_word_counts_skips_failures(self):
+        urls = [self.base + '/python.xml', self.base + '/gone',
+                os.path.join(TESTDATA, 'cooking.xml')]
+        results = dict((url, (title, wc)) for url, title, wc in
+                       generatefeedvector.fetch_word_counts(urls, workers=2, retries=0))
+
+        self.assertEqual(sorted(results), sorted([urls[0], urls[2]]))
+        title, wc = results[urls[0]]
+        self.assertEqual(title, 'Python Notes')
+        self.assertEqual(wc['python'], 4)
+        self.assertEqual(wc['generators'], 3)
+        # Tags are stripped from the summaries
+        self.assertNotIn('p', wc)
+
+    def test_build_blogdata(self):
+        feedlist = os.path.join(self.tmp, 'feedlist.txt')
+        out = os.path.join(self.tmp, 'blogdata.txt')
+        with open(feedlist, 'w') as f:
+            f.write('%s/python.xml\n' % self.base)
+            f.write('%s\n' % os.path.join(TESTDATA, 'cooking.xml'))
+            f.write('%s/travel.xml\n\n' % self.base)
+
+        wordcounts, wordlist = generatefeedvector.build_blogdata(feedlist, out, workers=2, retries=0)
+
+        self.assertEqual(sorted(wordcounts), ['Cooking Daily', 'Python Notes', 'Travel Log'])
+        # Words used more than once by exactly one of the three feeds
+        self.assertEqual(sorted(wordlist), ['and', 'bread', 'code', 'generators', 'needs', 'night',
+                                            'python', 'soup', 'time', 'trains', 'water'])
+
+        with open(out) as f:
+            lines = f.read().splitlines()
+        self.assertEqual(lines[0].split('\t'), ['Blog'] + wordlist)
+        rows = dict((line.split('\t')[0], line.split('\t')[1:]) for line in lines[1:])
+        self.assertEqual(sorted(rows), sorted(wordcounts))
+        for title, counts in rows.items():
+            self.assertEqual([int(c) for c in counts],
+                             [wordcounts[title].get(word, 0) for word in wordlist])
+
+
+class FeedVectorStoreTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def test_sparse_round_trip(self):
+        store = generatefeedvector.FeedVectorStore(os.path.join(self.tmp, 'feeds.db'))
+        store.add_feed('A', {'apple': 2, 'banana': 3, 'once': 1})
+        store.add_feed('B', {'banana': 2, 'cherry': 4})
+        store.add_feed('C', {'apple': 5, 'cherry': 2, 'once': 1})
+        # Padding feeds use no word more than once, so they have no cells
+        for i in range(7):
+            store.add_feed('Padding %d' % i, {'once': 1, 'word%d' % i: 1})
+        store.close()
+
+        # Everything added is still there after reopening the store
+        store = generatefeedvector.FeedVectorStore(os.path.join(self.tmp, 'feeds.db'))
+        self.assertEqual(store.feed_count(), 10)
+
+        out = os.path.join(self.tmp, 'sparse.txt')
+        self.assertEqual(store.write_sparse(out), 3)
+
+        rownames, colnames, data = clusters.readfile(out)
+        self.assertEqual(colnames, ['apple', 'banana', 'cherry'])
+        self.assertEqual(rownames, ['A', 'B', 'C'] + ['Padding %d' % i for i in range(7)])
+        self.assertEqual(data[:3], [[2.0, 3.0, 0.0], [0.0, 2.0, 4.0], [5.0, 0.0, 2.0]])
+        self.assertEqual(data[3:], [[0.0, 0.0, 0.0]] * 7)
+
+        cached_rownames, cached_colnames, matrix = clusters.load_matrix(
+            out, os.path.join(self.tmp, 'sparse'))
+        self.assertEqual((cached_rownames, cached_colnames), (rownames, colnames))
+        self.assertTrue(np.array_equal(matrix, np.array(data)))
+        store.close()
+
+
+if __name__ == '__main__':
+    unittest.main()
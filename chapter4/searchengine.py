@@ -1,15 +1,125 @@
 import urllib2
 from BeautifulSoup import *
-from urlparse import urljoin
+from urlparse import urljoin, urlparse
+import hashlib
+import numpy as np
+import os
+import Queue
 import sqlite3
+import struct
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from tokenizer import page_words
 
 ignore_words = set(['the', 'of', 'to', 'and', 'a', 'an', 'in', 'is', 'it'])
 
 
+# Set of strings in a fixed size bit array. Membership tests can give false
+# positives (about 2% at the default size with a million urls) but never false
+# negatives
+class BloomFilter:
+    def __init__(self, size=2 ** 23, hashes=7, bits=None):
+        self.size = size
+        self.hashes = hashes
+        self.bits = bytearray(bits) if bits is not None else bytearray(size // 8)
+
+    def positions(self, key):
+        if not isinstance(key, bytes):
+            key = key.encode('utf-8')
+        digest = hashlib.md5(key).hexdigest()
+        h1 = int(digest[:16], 16)
+        h2 = int(digest[16:], 16)
+        return [(h1 + i * h2) % self.size for i in range(self.hashes)]
+
+    def add(self, key):
+        for p in self.positions(key):
+            self.bits[p // 8] |= 1 << (p % 8)
+
+    def __contains__(self, key):
+        return all(self.bits[p // 8] & (1 << (p % 8)) for p in self.positions(key))
+
+    def to_bytes(self):
+        return struct.pack('>QI', self.size, self.hashes) + bytes(self.bits)
+
+    @staticmethod
+    def from_bytes(data):
+        data = bytes(data)
+        size, hashes = struct.unpack('>QI', data[:12])
+        return BloomFilter(size, hashes, data[12:])
+
+
+# Fetch and parse pages on `workers` threads, waiting at least `delay` seconds
+# between requests to the same host. Yields (url, soup) as pages finish, with
+# soup None for pages that could not be fetched
+def fetch_pages(pages, workers=8, delay=1.0, timeout=10):
+    tasks = Queue.Queue()
+    results = Queue.Queue()
+    next_request = {}
+    lock = threading.Lock()
+
+    def wait_for_host(url):
+        host = urlparse(url).netloc
+        with lock:
+            now = time.time()
+            start = max(now, next_request.get(host, now))
+            next_request[host] = start + delay
+        if start > now:
+            time.sleep(start - now)
+
+    def worker():
+        while True:
+            page = tasks.get()
+            if page is None:
+                return
+            try:
+                wait_for_host(page)
+                c = urllib2.urlopen(page, timeout=timeout)
+                results.put((page, BeautifulSoup(c.read())))
+            except Exception:
+                print "Could not open %s" % page
+                results.put((page, None))
+
+    threads = [threading.Thread(target=worker) for i in range(max(1, workers))]
+    for t in threads:
+        t.daemon = True
+        t.start()
+    for page in pages:
+        tasks.put(page)
+    for t in threads:
+        tasks.put(None)
+
+    for i in range(len(pages)):
+        yield results.get()
+
+
+# Concatenated index ranges indptr[i]:indptr[i + 1] for every i in nodes, and
+# for each index the position in nodes it came from
+def ragged_ranges(indptr, nodes):
+    starts = indptr[nodes]
+    lengths = indptr[nodes + 1] - starts
+    owner = np.repeat(np.arange(len(nodes)), lengths)
+    offsets = np.arange(lengths.sum()) - np.repeat(np.cumsum(lengths) - lengths, lengths)
+    return starts[owner] + offsets, owner
+
+
+# Indexes on the tables that grow with every page. Bulk loads drop them and
+# build them once at the end instead of updating them on every insert
+bulk_indexes = [('wordurlidx', 'wordlocation(wordid)'),
+                ('urltoidx', 'link(toid)'),
+                ('urlfromidx', 'link(fromid)')]
+
+
 class Crawler:
     def __init__(self, dbname):
         self.con = sqlite3.connect(dbname)
 
+        # word -> wordlist rowid for every word seen so far
+        self.word_ids = {}
+        self.bulk_loading = False
+
     def __del__(self):
         self.con.close()
 
@@ -18,14 +128,37 @@ class Crawler:
 
     def get_entry_id(self, table, field, value, create_new=True):
         # Gets entry id or create new one if doesn't exists
-        cur = self.con.execute("select rowid from %s where %s = '%s'" % (table, field, value))
+        cur = self.con.execute("select rowid from %s where %s = ?" % (table, field), (value,))
         result = cur.fetchone()
         if result is None:
-            cur = self.con.execute("insert into %s (%s) values ('%s')" % (table, field, value))
+            cur = self.con.execute("insert into %s (%s) values (?)" % (table, field), (value,))
             return cur.lastrowid
         else:
             return result[0]
 
+    # Gets wordlist ids for many words at once, creating the missing ones.
+    # Lookups go through the word_ids cache first and the database in batches
+    def get_word_ids(self, words):
+        missing = [w for w in set(words) if w not in self.word_ids]
+
+        # While bulk loading the cache holds every word, so anything missing is new
+        if not self.bulk_loading:
+            self.load_word_ids(missing)
+            missing = [w for w in missing if w not in self.word_ids]
+
+        if missing:
+            self.con.executemany('insert into wordlist (word) values (?)', [(w,) for w in missing])
+            self.load_word_ids(missing)
+
+        return self.word_ids
+
+    def load_word_ids(self, words):
+        for i in range(0, len(words), 500):
+            chunk = words[i:i + 500]
+            cur = self.con.execute('select word, rowid from wordlist where word in (%s)'
+                                   % ','.join(['?'] * len(chunk)), chunk)
+            self.word_ids.update(cur.fetchall())
+
     def add_to_index(self, url, soup):
         if self.is_indexed(url):
             return
@@ -38,13 +171,10 @@ class Crawler:
         urlid = self.get_entry_id('urllist', 'url', url)
 
         # Link each word to this url
-        for i in range(len(words)):
-            word = words[i]
-            if word in ignore_words:
-                continue
-            wordid = self.get_entry_id('wordlist', 'word', word)
-            self.con.execute("insert into wordlocation(urlid, wordid, location) values (%d, %d, %d)" \
-                             % (urlid, wordid, i))
+        word_ids = self.get_word_ids([w for w in words if w not in ignore_words])
+        self.con.executemany('insert into wordlocation(urlid, wordid, location) values (?, ?, ?)',
+                             [(urlid, word_ids[word], i) for i, word in enumerate(words)
+                              if word not in ignore_words])
 
     # Extract HTML text
     def get_text_only(self, soup):
@@ -61,14 +191,13 @@ class Crawler:
 
     # Separate words by non-whitespace characters
     def separate_words(self, text):
-        splitter = re.compile('\\W*')
-        return [s.lower() for s in splitter.split(text) if s != '']
+        return list(page_words(text))
 
     def is_indexed(self, url):
-        u = self.con.execute("select rowid from urllist where url='%s'" % url).fetchone()
+        u = self.con.execute("select rowid from urllist where url=?", (url,)).fetchone()
         if u is not None:
             # check if it's been crawled
-            v = self.con.execute('select * from wordlocation where urlid=%d' % u[0]).fetchone()
+            v = self.con.execute('select * from wordlocation where urlid=?', (u[0],)).fetchone()
             return v is not None
         return False
 
@@ -81,44 +210,87 @@ class Crawler:
         if from_id == to_id:
             return
 
-        cur = self.con.execute("insert into link(fromid, toid) values (%d, %d)" % (from_id, to_id))
+        cur = self.con.execute("insert into link(fromid, toid) values (?, ?)", (from_id, to_id))
         link_id = cur.lastrowid
 
-        for word in words:
-            if word in ignore_words:
-                continue
-            word_id = self.get_entry_id('wordlist', 'word', word)
-            self.con.execute("insert into linkwords(linkid, wordid) values (%d, %d)" % (link_id, word_id))
+        words = [w for w in words if w not in ignore_words]
+        word_ids = self.get_word_ids(words)
+        self.con.executemany("insert into linkwords(linkid, wordid) values (?, ?)",
+                             [(link_id, word_ids[word]) for word in words])
+
+    # Starting the first page, breadth first search to a given depth, indexing page as we go.
+    # Pages are fetched and parsed by a pool of worker threads (at most one
+    # request per `delay` seconds to each host) while this thread does all the
+    # indexing. The frontier and the set of queued urls are saved in the
+    # database, so an interrupted crawl picks up where it stopped when crawl is
+    # called again. A crawl that starts with an empty frontier starts afresh
+    def crawl(self, pages, depth=2, workers=8, delay=1.0, timeout=10):
+        self.create_crawl_tables()
+
+        if self.con.execute('select count(1) from frontier').fetchone()[0] > 0:
+            seen = self.load_seen()
+        else:
+            seen = BloomFilter()
+            for page in pages:
+                seen.add(page)
+                self.con.execute('insert or ignore into frontier(url, depth) values (?, ?)', (page, 0))
+            self.save_seen(seen)
+            self.dbcommit()
 
-    # Starting the first page, breadth first search to a given depth, indexing page as we go
-    def crawl(self, pages, depth=2):
         for i in range(depth):
-            newpages = set()
-            for page in pages:
-                try:
-                    c = urllib2.urlopen(page)
-                except:
-                    print "Could not open %s" % page
-                    continue
-                soup = BeautifulSoup(c.read())
-                self.add_to_index(page, soup)
-
-                links = soup('a')
-                for link in links:
-                    if ('href' in dict(link.attrs)):
-                        url = urljoin(page, link['href'])
-                        if url.find("'") != -1:
-                            continue
-                        url = url.split('#')[0]  # Remove location portion
-                        if url[0:4] == 'http' and not self.is_indexed(url):
-                            newpages.add(url)
-                        link_text = self.get_text_only(link)
-                        self.add_link_ref(page, url, link_text)
+            pages = [url for (url,) in self.con.execute('select url from frontier where depth=?', (i,))]
+            processed = 0
+            for page, soup in fetch_pages(pages, workers, delay, timeout):
+                if soup is not None:
+                    self.index_page(page, soup, seen, i + 1 if i + 1 < depth else None)
+                self.con.execute('delete from frontier where url=?', (page,))
+
+                processed += 1
+                if processed % 100 == 0:
+                    self.save_seen(seen)
                 self.dbcommit()
-            pages = newpages
+
+            self.save_seen(seen)
+            self.dbcommit()
+
+        # Anything left is deeper than this crawl goes
+        self.con.execute('delete from frontier')
+        self.dbcommit()
+
+    # Index a fetched page and its links. With a next_depth, links that have not
+    # been queued in this crawl and are not indexed yet are queued at that depth
+    def index_page(self, page, soup, seen, next_depth=None):
+        self.add_to_index(page, soup)
+
+        links = soup('a')
+        for link in links:
+            if ('href' in dict(link.attrs)):
+                url = urljoin(page, link['href'])
+                url = url.split('#')[0]  # Remove location portion
+                if (next_depth is not None and url[0:4] == 'http' and url not in seen and
+                        not self.is_indexed(url)):
+                    seen.add(url)
+                    self.con.execute('insert or ignore into frontier(url, depth) values (?, ?)',
+                                     (url, next_depth))
+                link_text = self.get_text_only(link)
+                self.add_link_ref(page, url, link_text)
+
+    def create_crawl_tables(self):
+        self.con.execute('CREATE TABLE IF NOT EXISTS frontier(url PRIMARY KEY, depth INTEGER)')
+        self.con.execute('CREATE TABLE IF NOT EXISTS crawlstate(name PRIMARY KEY, value)')
+
+    def load_seen(self):
+        row = self.con.execute("select value from crawlstate where name='seen'").fetchone()
+        if row is None:
+            return BloomFilter()
+        return BloomFilter.from_bytes(row[0])
+
+    def save_seen(self, seen):
+        self.con.execute("insert or replace into crawlstate(name, value) values ('seen', ?)",
+                         (sqlite3.Binary(seen.to_bytes()),))
 
     # Create db table
-    def create_index_tables(self):
+    def create_index_tables(self, bulk_load=False):
         self.con.execute('CREATE TABLE urllist(url)')
         self.con.execute('CREATE TABLE wordlist(word)')
         self.con.execute('CREATE TABLE wordlocation(urlid, wordid, location)')
@@ -126,35 +298,292 @@ class Crawler:
         self.con.execute('CREATE TABLE linkwords(wordid, linkid)')
         self.con.execute('CREATE INDEX wordidx ON wordlist(word)')
         self.con.execute('CREATE INDEX urlidx ON urllist(url)')
-        self.con.execute('CREATE INDEX wordurlidx ON wordlocation(wordid)')
-        self.con.execute('CREATE INDEX urltoidx ON link(toid)')
-        self.con.execute('CREATE INDEX urlfromidx ON link(fromid)')
+        if bulk_load:
+            self.begin_bulk_load()
+        else:
+            self.create_bulk_indexes()
+        self.dbcommit()
+
+    def create_bulk_indexes(self):
+        for name, columns in bulk_indexes:
+            self.con.execute('CREATE INDEX IF NOT EXISTS %s ON %s' % (name, columns))
+
+    # Bulk-load mode for large crawls: the wordlocation and link indexes are
+    # dropped, every known word is cached up front so new words need no lookup,
+    # and SQLite skips syncing to disk. end_bulk_load builds the indexes again
+    def begin_bulk_load(self):
+        for name, columns in bulk_indexes:
+            self.con.execute('DROP INDEX IF EXISTS %s' % name)
+        self.word_ids.update(self.con.execute('select word, rowid from wordlist'))
+        # The safety level can't be changed inside a transaction
         self.dbcommit()
+        self.con.execute('PRAGMA synchronous = OFF')
+        self.bulk_loading = True
 
-    def calculate_pagerank(self, iterations=20):
+    def end_bulk_load(self):
+        self.bulk_loading = False
+        self.create_bulk_indexes()
+        self.dbcommit()
+        self.con.execute('PRAGMA synchronous = FULL')
+
+    # Link graph as CSR arrays over the urllist rows. urlids holds the urllist
+    # rowid of each node, the nodes linking to node i are
+    # sources[indptr[i]:indptr[i + 1]] and out_degree counts every link row
+    # leaving a node (duplicates included, like the old count(1) query)
+    def load_link_graph(self):
+        urlids = np.array([u for (u,) in self.con.execute('select rowid from urllist order by rowid')],
+                          dtype=np.int64)
+        n = len(urlids)
+
+        links = np.array(self.con.execute('select distinct fromid, toid from link').fetchall(),
+                         dtype=np.int64).reshape(-1, 2)
+        from_idx = np.searchsorted(urlids, links[:, 0])
+        to_idx = np.searchsorted(urlids, links[:, 1])
+
+        degrees = np.array(self.con.execute('select fromid, count(1) from link group by fromid').fetchall(),
+                           dtype=np.int64).reshape(-1, 2)
+        out_degree = np.zeros(n)
+        out_degree[np.searchsorted(urlids, degrees[:, 0])] = degrees[:, 1]
+
+        order = np.argsort(to_idx, kind='mergesort')
+        sources = from_idx[order]
+        indptr = np.zeros(n + 1, dtype=np.int64)
+        indptr[1:] = np.cumsum(np.bincount(to_idx, minlength=n))
+        return urlids, indptr, sources, out_degree
+
+    # PageRank by power iteration over the CSR link graph. Stops after
+    # `iterations` rounds or once no score moves by more than tolerance
+    def calculate_pagerank(self, iterations=100, tolerance=1e-6):
         self.con.execute('DROP TABLE IF EXISTS pagerank')
         self.con.execute('CREATE TABLE pagerank(urlid PRIMARY KEY, score)')
 
+        urlids, indptr, sources, out_degree = self.load_link_graph()
+        n = len(urlids)
+        targets = np.repeat(np.arange(n), np.diff(indptr))
+        share = 1.0 / out_degree[sources]
+
         # initialize with 1
-        self.con.execute('INSERT INTO pagerank SELECT rowid, 1.0 FROM urllist')
+        pr = np.ones(n)
+        for i in range(iterations):
+            print 'Iteration %d' % (i)
+            new_pr = 0.15 + 0.85 * np.bincount(targets, weights=pr[sources] * share, minlength=n)
+            change = np.abs(new_pr - pr).max() if n else 0.0
+            pr = new_pr
+            if change <= tolerance:
+                break
+
+        self.con.executemany('INSERT INTO pagerank(urlid, score) VALUES (?, ?)',
+                             zip(urlids.tolist(), pr.tolist()))
+        self.save_pagerank_state()
         self.dbcommit()
 
+    # Remember the newest link the pagerank table accounts for
+    def save_pagerank_state(self):
+        self.create_crawl_tables()
+        last_link = self.con.execute('select max(rowid) from link').fetchone()[0] or 0
+        self.con.execute("insert or replace into crawlstate(name, value) values ('pagerank_link', ?)",
+                         (last_link,))
+
+    # Refresh PageRank after a partial crawl. Starts from the scores already in
+    # the pagerank table (new pages start at 1.0) and only recomputes pages whose
+    # inbound links changed: the targets of every page that gained links since
+    # the last run, and the new pages themselves. A page whose score moves by
+    # more than tolerance passes the change on to the pages it links to.
+    # Links are only ever added by the crawler, so removals are not tracked
+    def update_pagerank(self, tolerance=1e-6, iterations=100):
+        has_table = self.con.execute("select count(1) from sqlite_master where type='table' "
+                                     "and name='pagerank'").fetchone()[0]
+        self.create_crawl_tables()
+        state = self.con.execute("select value from crawlstate where name='pagerank_link'").fetchone()
+        if not has_table or state is None:
+            return self.calculate_pagerank(iterations, tolerance)
+
+        urlids, indptr, sources, out_degree = self.load_link_graph()
+        n = len(urlids)
+        targets = np.repeat(np.arange(n), np.diff(indptr))
+        share = 1.0 / out_degree[sources]
+
+        # Outbound CSR: the pages node i links to are out_targets[out_indptr[i]:out_indptr[i + 1]]
+        order = np.argsort(sources, kind='mergesort')
+        out_targets = targets[order]
+        out_indptr = np.zeros(n + 1, dtype=np.int64)
+        out_indptr[1:] = np.cumsum(np.bincount(sources, minlength=n))
+
+        # Warm start from the stored scores
+        pr = np.ones(n)
+        stored = np.array(self.con.execute('select urlid, score from pagerank').fetchall()).reshape(-1, 2)
+        known = np.zeros(n, dtype=bool)
+        if len(stored):
+            pos = np.searchsorted(urlids, stored[:, 0].astype(np.int64))
+            valid = (pos < n) & (urlids[np.minimum(pos, n - 1)] == stored[:, 0])
+            pr[pos[valid]] = stored[valid, 1]
+            known[pos[valid]] = True
+
+        changed_from = np.array([f for (f,) in self.con.execute(
+            'select distinct fromid from link where rowid > ?', (state[0],))], dtype=np.int64)
+        changed_from = np.searchsorted(urlids, changed_from)
+        active = np.union1d(out_targets[ragged_ranges(out_indptr, changed_from)[0]],
+                            np.nonzero(~known)[0])
+        start_pr = pr.copy()
+
         for i in range(iterations):
-            print 'Iteration %d' % (i)
-            for (urlid,) in self.con.execute('SELECT rowid FROM urllist'):
-                pr = 0.15
-
-                for (linker,) in self.con.execute('select distinct fromid from link where toid=%d' % urlid):
-                    linking_pr = self.con.execute('select score from pagerank where urlid=%d' % linker).fetchone()[0]
-                    linking_count = self.con.execute('select count(1) from link where fromid=%d' % linker).fetchone()[0]
-                    pr += 0.85 * (linking_pr / linking_count)
-                self.con.execute('update pagerank set score=%f where urlid=%d' % (pr, urlid))
-            self.dbcommit()
+            if len(active) == 0:
+                break
+            print 'Iteration %d (%d pages)' % (i, len(active))
+            if 4 * len(active) > n:
+                # Once the change has spread this far a full sweep is cheaper
+                new_pr = 0.15 + 0.85 * np.bincount(targets, weights=pr[sources] * share, minlength=n)
+                moved = np.nonzero(np.abs(new_pr - pr) > tolerance)[0]
+                pr = new_pr
+            else:
+                edges, owner = ragged_ranges(indptr, active)
+                new_pr = 0.15 + 0.85 * np.bincount(owner, weights=pr[sources[edges]] * share[edges],
+                                                   minlength=len(active))
+                moved = active[np.abs(new_pr - pr[active]) > tolerance]
+                pr[active] = new_pr
+
+            # Pages linked from a page whose score moved need another look
+            if 4 * len(moved) > n:
+                active = np.arange(n)
+            else:
+                next_active = np.zeros(n, dtype=bool)
+                next_active[out_targets[ragged_ranges(out_indptr, moved)[0]]] = True
+                active = np.nonzero(next_active)[0]
+
+        updated = np.nonzero((pr != start_pr) | ~known)[0]
+        self.con.executemany('INSERT OR REPLACE INTO pagerank(urlid, score) VALUES (?, ?)',
+                             zip(urlids[updated].tolist(), pr[updated].tolist()))
+        self.save_pagerank_state()
+        self.dbcommit()
+        return len(updated)
+
+
+# Variable-byte encoding of non-negative integers: 7 bits per byte, the high
+# bit set on every byte except the last one of each number
+def varint_encode(values):
+    values = np.asarray(values, dtype=np.uint64)
+    nbytes = np.ones(len(values), dtype=np.int64)
+    for bits in (7, 14, 21, 28, 35, 42, 49, 56, 63):
+        nbytes += values >= (np.uint64(1) << np.uint64(bits))
+    owner = np.repeat(np.arange(len(values)), nbytes)
+    k = np.arange(nbytes.sum()) - np.repeat(np.cumsum(nbytes) - nbytes, nbytes)
+    out = (values[owner] >> (np.uint64(7) * k.astype(np.uint64))) & np.uint64(127)
+    out[k < nbytes[owner] - 1] |= np.uint64(128)
+    return out.astype(np.uint8)
+
+
+def varint_decode(data):
+    data = np.asarray(data, dtype=np.uint8)
+    if len(data) == 0:
+        return np.zeros(0, dtype=np.int64)
+    ends = np.nonzero(data < 128)[0]
+    starts = np.concatenate(([0], ends[:-1] + 1))
+    k = np.arange(len(data)) - np.repeat(starts, ends - starts + 1)
+    parts = (data & 127).astype(np.uint64) << (np.uint64(7) * k.astype(np.uint64))
+    return np.add.reduceat(parts, starts).astype(np.int64)
+
+
+# Positional inverted index over wordlocation, memory-mapped from a file. Each
+# word's posting list is the varint encoding of its url ids (delta-encoded),
+# the number of positions per url and the positions within each url
+# (delta-encoded per url). A sidecar .lex.npy holds, per word id, the byte
+# offset and length of its list and its url and position counts
+class PositionalIndex:
+    def __init__(self, filename):
+        lexicon = np.load(filename + '.lex.npy')
+        self.lexicon = dict((int(row[0]), row[1:]) for row in lexicon)
+        if os.path.getsize(filename) > 0:
+            self.data = np.memmap(filename, dtype=np.uint8, mode='r')
+        else:
+            self.data = np.zeros(0, dtype=np.uint8)
+
+    @staticmethod
+    def build(con, filename):
+        rows = np.array(con.execute('select wordid, urlid, location from wordlocation').fetchall(),
+                        dtype=np.int64).reshape(-1, 3)
+        rows = rows[np.lexsort((rows[:, 2], rows[:, 1], rows[:, 0]))]
+        words, urls, locations = rows[:, 0], rows[:, 1], rows[:, 2]
+
+        # Boundaries of every word and of every (word, url) pair
+        new_word = np.ones(len(rows), dtype=bool)
+        new_word[1:] = words[1:] != words[:-1]
+        new_doc = new_word.copy()
+        new_doc[1:] |= urls[1:] != urls[:-1]
+        word_starts = np.nonzero(new_word)[0]
+        doc_starts = np.nonzero(new_doc)[0]
+        doc_counts = np.diff(np.append(doc_starts, len(rows)))
+
+        position_deltas = locations.copy()
+        position_deltas[1:] -= locations[:-1]
+        position_deltas[new_doc] = locations[new_doc]
+
+        doc_urls = urls[doc_starts]
+        doc_words = words[doc_starts]
+        doc_deltas = doc_urls.copy()
+        doc_deltas[1:] -= doc_urls[:-1]
+        word_of_doc_start = np.ones(len(doc_starts), dtype=bool)
+        word_of_doc_start[1:] = doc_words[1:] != doc_words[:-1]
+        doc_deltas[word_of_doc_start] = doc_urls[word_of_doc_start]
+        word_doc_starts = np.append(np.nonzero(word_of_doc_start)[0], len(doc_starts))
+
+        lexicon = []
+        offset = 0
+        with open(filename, 'wb') as f:
+            for w in range(len(word_starts)):
+                d0, d1 = word_doc_starts[w], word_doc_starts[w + 1]
+                p0 = word_starts[w]
+                p1 = word_starts[w + 1] if w + 1 < len(word_starts) else len(rows)
+                encoded = varint_encode(np.concatenate((doc_deltas[d0:d1], doc_counts[d0:d1],
+                                                        position_deltas[p0:p1])))
+                f.write(encoded.tobytes())
+                lexicon.append((words[p0], offset, len(encoded), d1 - d0, p1 - p0))
+                offset += len(encoded)
+
+        np.save(filename + '.lex.npy', np.array(lexicon, dtype=np.int64).reshape(-1, 5))
+        return PositionalIndex(filename)
+
+    # Url ids, positions per url and absolute positions of a word
+    def postings(self, word_id):
+        offset, length, ndocs, npositions = self.lexicon[word_id]
+        values = varint_decode(self.data[offset:offset + length])
+        urls = np.cumsum(values[:ndocs])
+        counts = values[ndocs:2 * ndocs]
+        deltas = values[2 * ndocs:]
+
+        # Undo the per-url delta encoding: running sum restarted at every url
+        running = np.cumsum(deltas)
+        starts = np.cumsum(counts) - counts
+        positions = running - np.repeat(running[starts] - deltas[starts], counts)
+        return urls, counts, positions
+
+    # Urls containing every word, found by intersecting the posting lists, with
+    # the positions of each word in each url: {urlid: [positions, ...]}
+    def match(self, word_ids):
+        if not word_ids or any(w not in self.lexicon for w in word_ids):
+            return {}
+
+        postings = [self.postings(w) for w in word_ids]
+        order = sorted(range(len(postings)), key=lambda i: len(postings[i][0]))
+        urls = postings[order[0]][0]
+        for i in order[1:]:
+            urls = np.intersect1d(urls, postings[i][0], assume_unique=True)
+
+        per_word = []
+        for word_urls, counts, positions in postings:
+            docs = np.searchsorted(word_urls, urls)
+            starts = np.cumsum(counts) - counts
+            per_word.append([positions[starts[d]:starts[d] + counts[d]] for d in docs])
+
+        return dict((int(u), [per_word[w][i] for w in range(len(word_ids))])
+                    for i, u in enumerate(urls.tolist()))
 
 
 class Searcher:
-    def __init__(self, dbname):
+    # index is an optional PositionalIndex, which query then uses instead of
+    # the wordlocation self-join
+    def __init__(self, dbname, index=None):
         self.con = sqlite3.connect(dbname)
+        self.index = index
 
     def __del__(self):
         self.con.close()
@@ -211,10 +640,40 @@ class Searcher:
     def get_url_name(self, id):
         return self.con.execute("select url from urllist where rowid=%d" % id).fetchone()[0]
 
-    def query(self, q):
-        rows, word_ids = self.get_match_rows(q)
+    # Same as get_match_rows but through the positional index: returns
+    # {urlid: [positions of each word]} instead of every combination of positions
+    def get_matches(self, q):
+        word_ids = []
+        for word in q.split(' '):
+            word_row = self.con.execute("select rowid from wordlist where word=?", (word,)).fetchone()
+            if word_row is not None:
+                word_ids.append(word_row[0])
+        return self.index.match(word_ids), word_ids
+
+    def get_match_scored_list(self, matches, word_ids):
+        total_scores = dict([(url, 0) for url in matches])
+        if not matches:
+            return total_scores
+
+        rows = [(url,) for url in matches]
+        weights = [(1.0, self.match_frequency_score(matches)),
+                   (1.0, self.match_location_score(matches)),
+                   (1.0, self.pagerank_score(rows)),
+                   (1.0, self.linktext_score(rows, word_ids))]
+
+        for (weight, scores) in weights:
+            for url in total_scores:
+                total_scores[url] += weight * scores[url]
 
-        scores = self.get_scored_list(rows, word_ids)
+        return total_scores
+
+    def query(self, q):
+        if self.index is not None:
+            matches, word_ids = self.get_matches(q)
+            scores = self.get_match_scored_list(matches, word_ids)
+        else:
+            rows, word_ids = self.get_match_rows(q)
+            scores = self.get_scored_list(rows, word_ids)
         ranked_scores = sorted([(score, url) for (url, score) in scores.items()], reverse=1)
         for (score, url_id) in ranked_scores[0:10]:
             print '%f\t%s' % (score, self.get_url_name(url_id))
@@ -257,6 +716,51 @@ class Searcher:
 
         return self.normalize_scores(min_distance, small_is_better=True)
 
+    # frequency_score from positional matches: the number of rows the self-join
+    # would return is the product of each word's position count
+    def match_frequency_score(self, matches):
+        counts = {}
+        for (u, positions) in matches.items():
+            counts[u] = 1
+            for p in positions:
+                counts[u] *= len(p)
+        return self.normalize_scores(counts, small_is_better=False)
+
+    # location_score from positional matches: the smallest sum of locations is
+    # the sum of each word's first location
+    def match_location_score(self, matches):
+        locations = dict((u, sum([int(p[0]) for p in positions])) for (u, positions) in matches.items())
+        return self.normalize_scores(locations, small_is_better=True)
+
+    # distance_score from positional matches. The smallest total gap between
+    # consecutive query words is found word by word, keeping the best total
+    # ending at each position of the current word. For a position q the best
+    # previous position p <= q minimizes best - p and the best p > q minimizes
+    # best + p, so prefix and suffix minima over the sorted positions plus one
+    # searchsorted give every q in O(n log n), without pairing up positions
+    def match_distance_score(self, matches):
+        min_distance = {}
+        for (u, positions) in matches.items():
+            if len(positions) < 2:
+                min_distance[u] = 1.0
+                continue
+            best = np.zeros(len(positions[0]))
+            for i in range(1, len(positions)):
+                previous = positions[i - 1]
+                current = positions[i]
+                below = np.minimum.accumulate(best - previous)
+                above = np.minimum.accumulate((best + previous)[::-1])[::-1]
+                split = np.searchsorted(previous, current, side='right')
+                from_below = np.where(split > 0, below[np.maximum(split - 1, 0)] + current, np.inf)
+                from_above = np.where(split < len(previous),
+                                      above[np.minimum(split, len(previous) - 1)] - current, np.inf)
+                best = np.minimum(from_below, from_above)
+            min_distance[u] = int(best.min())
+
+        if all(len(p) < 2 for p in matches.values()):
+            return min_distance
+        return self.normalize_scores(min_distance, small_is_better=True)
+
     def inbound_link_score(self, rows):
         unique_urls = set([row[0] for row in rows])
         inbound_count = dict([(u, self.con.execute('select count(1) from link where toid=%d' % u).fetchone()[0]) \
@@ -0,0 +1,188 @@
+import os
+import random
+import shutil
+import sys
+import tempfile
+import threading
+import unittest
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+from SocketServer import ThreadingMixIn
+
+import searchengine
+
+# Small local site standing in for the web: p0 links to p1, p2 and a missing
+# page, p1 to p3 and p3 to p4
+PAGES = {
+    '/p0.html': '<html><body>start page <a href="p1.html">first</a> <a href="p2.html#top">second</a>'
+                ' <a href="missing.html">broken</a></body></html>',
+    '/p1.html': '<html><body>python crawler <a href="p3.html">deeper</a></body></html>',
+    '/p2.html': '<html><body>python search <a href="p0.html">home</a></body></html>',
+    '/p3.html': '<html><body>deep page <a href="p4.html">deepest</a></body></html>',
+    '/p4.html': '<html><body>deepest page</body></html>',
+}
+
+
+class SiteHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        body = PAGES.get(self.path)
+        if body is None:
+            self.send_error(404)
+            return
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/html')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body.encode('utf-8'))
+
+    def log_message(self, format, *args):
+        pass
+
+
+class ThreadingServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class CrawlerTest(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.server = ThreadingServer(('127.0.0.1', 0), SiteHandler)
+        cls.base = 'http://127.0.0.1:%d/' % cls.server.server_port
+        cls.thread = threading.Thread(target=cls.server.serve_forever)
+        cls.thread.daemon = True
+        cls.thread.start()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.shutdown()
+        cls.server.server_close()
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.dbname = os.path.join(self.tmp, 'index.db')
+        crawler = searchengine.Crawler(self.dbname)
+        crawler.create_index_tables()
+        del crawler
+
+        # Keep the crawler's progress output out of the test report
+        self.stdout = sys.stdout
+        sys.stdout = open(os.devnull, 'w')
+
+    def tearDown(self):
+        sys.stdout.close()
+        sys.stdout = self.stdout
+        shutil.rmtree(self.tmp)
+
+    def crawl(self, pages, depth):
+        crawler = searchengine.Crawler(self.dbname)
+        crawler.crawl([self.base + page for page in pages], depth=depth, workers=2, delay=0, timeout=5)
+        return crawler
+
+    def indexed(self, crawler):
+        return sorted(url[len(self.base):] for (url,) in crawler.con.execute(
+            'select url from urllist where rowid in (select distinct urlid from wordlocation)'))
+
+    def test_crawl_to_depth(self):
+        crawler = self.crawl(['p0.html'], depth=2)
+        self.assertEqual(self.indexed(crawler), ['p0.html', 'p1.html', 'p2.html'])
+
+        # Links of the last level are recorded but not fetched
+        urls = [url for (url,) in crawler.con.execute('select url from urllist')]
+        self.assertTrue(self.base + 'p3.html' in urls)
+        self.assertEqual(crawler.con.execute('select count(1) from frontier').fetchone()[0], 0)
+
+    def test_later_crawl_fetches_pages_seen_before(self):
+        self.crawl(['p0.html'], depth=2)
+
+        # p3 was only linked to by the first crawl, a new one from p1 reaches it
+        crawler = self.crawl(['p1.html'], depth=2)
+        self.assertEqual(self.indexed(crawler), ['p0.html', 'p1.html', 'p2.html', 'p3.html'])
+
+    def test_resume_interrupted_crawl(self):
+        # State left by a crawl that stopped with p3 queued at depth 1
+        crawler = searchengine.Crawler(self.dbname)
+        crawler.create_crawl_tables()
+        seen = searchengine.BloomFilter()
+        seen.add(self.base + 'p3.html')
+        crawler.save_seen(seen)
+        crawler.con.execute('insert into frontier(url, depth) values (?, ?)', (self.base + 'p3.html', 1))
+        crawler.dbcommit()
+        del crawler
+
+        # Resuming ignores the seed pages and carries on from the frontier
+        crawler = self.crawl(['p0.html'], depth=2)
+        self.assertEqual(self.indexed(crawler), ['p3.html'])
+        self.assertEqual(crawler.con.execute('select count(1) from frontier').fetchone()[0], 0)
+
+
+class BloomFilterTest(unittest.TestCase):
+    def test_membership_and_round_trip(self):
+        seen = searchengine.BloomFilter(size=2 ** 16, hashes=5)
+        for i in range(100):
+            seen.add('http://example.com/%d' % i)
+
+        copy = searchengine.BloomFilter.from_bytes(seen.to_bytes())
+        for i in range(100):
+            self.assertTrue('http://example.com/%d' % i in copy)
+        self.assertFalse('http://example.com/other' in copy)
+
+
+class PositionalIndexTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.dbname = os.path.join(self.tmp, 'index.db')
+
+        # Thirty pages of random words, so words repeat within pages
+        crawler = searchengine.Crawler(self.dbname)
+        crawler.create_index_tables()
+        words = ['alpha', 'beta', 'gamma', 'delta', 'epsilon']
+        crawler.con.executemany('insert into wordlist(word) values (?)', [(w,) for w in words])
+        rng = random.Random(0)
+        for page in range(30):
+            crawler.con.execute('insert into urllist(url) values (?)', ('http://example.com/%d' % page,))
+            crawler.con.executemany('insert into wordlocation(urlid, wordid, location) values (?, ?, ?)',
+                                    [(page + 1, rng.randint(1, len(words)), location)
+                                     for location in range(rng.randint(1, 40))])
+        crawler.dbcommit()
+
+        index = searchengine.PositionalIndex.build(crawler.con, os.path.join(self.tmp, 'index.pos'))
+        del crawler
+        self.searcher = searchengine.Searcher(self.dbname, index)
+
+    def tearDown(self):
+        del self.searcher
+        shutil.rmtree(self.tmp)
+
+    def test_varint_round_trip(self):
+        values = [0, 1, 127, 128, 300, 16383, 16384, 2 ** 31, 2 ** 40]
+        decoded = searchengine.varint_decode(searchengine.varint_encode(values))
+        self.assertEqual(decoded.tolist(), values)
+
+    def test_matches_and_scores_agree_with_rows(self):
+        searcher = self.searcher
+        for q in ['alpha', 'alpha beta', 'beta alpha', 'alpha alpha', 'gamma delta epsilon',
+                  'alpha beta gamma delta', 'nosuchword beta']:
+            rows, word_ids = searcher.get_match_rows(q)
+            matches, match_word_ids = searcher.get_matches(q)
+            self.assertEqual(match_word_ids, word_ids)
+
+            # Same urls, and each word's positions are the ones the self-join combines
+            self.assertEqual(sorted(matches), sorted(set(row[0] for row in rows)))
+            for url, positions in matches.items():
+                url_rows = [row for row in rows if row[0] == url]
+                for w in range(len(word_ids)):
+                    self.assertEqual(positions[w].tolist(), sorted(set(row[w + 1] for row in url_rows)))
+
+            for expected, actual in [(searcher.frequency_score(rows), searcher.match_frequency_score(matches)),
+                                     (searcher.location_score(rows), searcher.match_location_score(matches)),
+                                     (searcher.distance_score(rows), searcher.match_distance_score(matches))]:
+                self.assertEqual(sorted(expected), sorted(actual))
+                for url in expected:
+                    self.assertAlmostEqual(expected[url], actual[url], places=9)
+
+    def test_missing_word_matches_nothing(self):
+        self.assertEqual(self.searcher.index.match([12345]), {})
+        self.assertEqual(self.searcher.index.match([]), {})
+
+
+if __name__ == '__main__':
+    unittest.main()
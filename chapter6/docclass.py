@@ -1,15 +1,15 @@
-import re
 import math
+import os
 import sqlite3
+import sys
 
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from tokenizer import feature_words
 
-def get_words(doc):
-    splitter = re.compile('\\W*')
-    words = [s.lower() for s in splitter.split(doc)
-             if len(s) > 2 and len(s) < 20]
 
+def get_words(doc):
     # Return the unique set of words only
-    return dict([(w, 1) for w in words])
+    return dict([(w, 1) for w in feature_words(doc)])
 
 
 def sample_train(classifier):
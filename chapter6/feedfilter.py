@@ -1,5 +1,9 @@
 import feedparser
-import re
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from tokenizer import feature_words
 
 
 def read(feed, classifier):
@@ -23,18 +27,14 @@ def read(feed, classifier):
         classifier.train(full_text, cl)
 
 def entry_features(entry):
-    splitter = re.compile('\\W*')
     feature = {}
 
     # Extract title words
-    title_words = [s.lower() for s in splitter.split(entry['title'])
-                   if len(s) > 2 and len(s) < 20]
-    for word in title_words:
+    for word in feature_words(entry['title']):
         feature['Title:'+word]=1
 
     # Extract summary words
-    summary_words = [s.lower() for s in splitter.split(entry['summary'])
-                     if len(s) > 2 and len(s) <20]
+    summary_words = list(feature_words(entry['summary']))
 
     uppercase_count = 0
     for i in range(len(summary_words)):
@@ -0,0 +1,6 @@
+import sys
+
+# chapter4 is still Python 2 code, its tests only run under Python 2
+collect_ignore = []
+if sys.version_info[0] >= 3:
+    collect_ignore.append('chapter4/test_searchengine.py')